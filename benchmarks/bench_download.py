@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+from benchmarks.measure import timed
+from hca_cellxgene.helpers.downloader import Downloader
+
+
+class RangeFileServer:
+    # Local file server supporting HTTP Range requests, like the S3 buckets Azul redirects to.
+    # Each response can be throttled to mimic the per-connection bandwidth of the real thing, and it can drop
+    # connections part way through a response to exercise resuming.
+    def __init__(self, directory: os.PathLike, bandwidth: float = 0, fail_after: int = 0):
+        self.directory = Path(directory)
+        self.bandwidth = bandwidth
+        self.fail_after = fail_after
+        self.request_count = 0
+        self.base_url = None
+        self.__server = None
+
+    def __enter__(self) -> 'RangeFileServer':
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.__server.server_port}'
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler) -> None:
+        self.request_count += 1
+        path = Path(self.directory, request.path.split('?')[0].lstrip('/'))
+        size = path.stat().st_size
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        start, end = (int(match.group(1)), int(match.group(2) or size - 1)) if match else (0, size - 1)
+        if start >= size:
+            request.send_response(416)
+            request.send_header('Content-Range', f'bytes */{size}')
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        end = min(end, size - 1)
+        request.send_response(206 if match else 200)
+        request.send_header('Content-Length', str(end - start + 1))
+        request.send_header('ETag', f'"{size}-{path.stat().st_mtime_ns}"')
+        if match:
+            request.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        request.end_headers()
+
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while start + sent <= end:
+                block = f.read(min(2 ** 16, end - start - sent + 1))
+                if self.fail_after and sent >= self.fail_after:
+                    # Drop the connection part way through the response
+                    request.close_connection = True
+                    return
+                request.wfile.write(block)
+                sent += len(block)
+                if self.bandwidth:
+                    time.sleep(len(block) / self.bandwidth)
+
+
+def download_original(url: str, download_path: Path) -> None:
+    # The original utils.download_file: a new connection and 1 KiB blocks
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    with open(download_path, 'wb') as f:
+        for data in response.iter_content(1024):
+            f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the original downloader with the segmented downloader '
+                                                 'against a local HTTP server')
+    parser.add_argument('--size', type=int, default=256, help='Size of the file to download in MiB')
+    parser.add_argument('--bandwidth', type=float, default=50, help='Bandwidth of each connection in MiB/s')
+    parser.add_argument('--segments', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp, 'matrices.tar.gz')
+        with open(source, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(2 ** 20))
+        expected = hashlib.sha256(source.read_bytes()).hexdigest()
+
+        cases = {
+            'original': lambda url, path: download_original(url, path),
+            'downloader_1_segment': lambda url, path: Downloader(segments=1).download(url, path),
+            f'downloader_{args.segments}_segments': lambda url, path: Downloader(
+                segments=args.segments, min_segment_size=2 ** 20
+            ).download(url, path, {'sha256': expected}),
+        }
+        with RangeFileServer(tmp, bandwidth=args.bandwidth * 2 ** 20) as server:
+            for name, download in cases.items():
+                download_path = Path(tmp, 'downloads', name, 'matrices.tar.gz')
+                download_path.parent.mkdir(parents=True)
+                with timed({}) as result:
+                    download(f'{server.base_url}/matrices.tar.gz', download_path)
+                print(f'{name:>24}: {result["wall_time"]:8.2f}s '
+                      f'{args.size / result["wall_time"]:8.1f} MiB/s')
+
+        # Drop every response part way through, so the download only completes by resuming each segment
+        with RangeFileServer(tmp, fail_after=2 ** 20) as server:
+            download_path = Path(tmp, 'downloads', 'resumed', 'matrices.tar.gz')
+            Downloader(segments=args.segments, min_segment_size=2 ** 20, max_retries=args.size * 2).download(
+                f'{server.base_url}/matrices.tar.gz', download_path, {'sha256': expected}
+            )
+            print(f'{"resumed":>24}: verified after {server.request_count} requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import gzip
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+
+from benchmarks.measure import run_isolated, timed
+from benchmarks.synthetic import write_matrix
+from hca_cellxgene.helpers import mtx
+
+
+def load_with_sparse_data_frame(matrix_file_path):
+    # The original loader in H5AD.py
+    matrix = pd.DataFrame.sparse.from_spmatrix(sio.mmread(matrix_file_path))
+    return matrix.transpose()
+
+
+LOADERS = {
+    'sparse_data_frame': load_with_sparse_data_frame,
+    'csr': mtx.load_csr,
+}
+
+# MatrixMarket files the CSR loader must read as scipy.io.mmread does: (header, entries)
+PARITY_CASES = {
+    'empty': ('%%MatrixMarket matrix coordinate integer general\n3 4 0\n', ''),
+    'empty_cells': ('%%MatrixMarket matrix coordinate integer general\n3 4 2\n', '1 1 5\n3 1 2\n'),
+    'unsorted': ('%%MatrixMarket matrix coordinate integer general\n3 4 3\n', '2 4 1\n1 1 5\n3 2 2\n'),
+    'real': ('%%MatrixMarket matrix coordinate real general\n% comment\n3 4 2\n', '1 2 0.5\n3 3 1e-3\n'),
+    'pattern': ('%%MatrixMarket matrix coordinate pattern general\n3 4 2\n', '1 2\n3 3\n'),
+}
+
+
+def check_parity(directory: Path) -> None:
+    # Loads each case with the CSR loader and mmread and fails if they differ. Each case is also gzipped without a .gz
+    # extension, as contributor files sometimes are, which the loader has to detect by content
+    for name, (header, entries) in PARITY_CASES.items():
+        plain_path, gzipped_path = Path(directory, f'{name}.mtx'), Path(directory, f'{name}_gzipped.mtx')
+        plain_path.write_text(header + entries)
+        gzipped_path.write_bytes(gzip.compress((header + entries).encode()))
+        expected = sio.mmread(plain_path).T.toarray()
+        for matrix_file_path in [plain_path, gzipped_path]:
+            actual = mtx.load_csr(matrix_file_path)
+            if actual.shape != expected.shape or not np.array_equal(actual.toarray(), expected):
+                raise AssertionError(f'The CSR loader differs from mmread on {matrix_file_path.name}')
+    print(f'The CSR loader matches mmread on the {", ".join(PARITY_CASES)} matrices, plain and gzipped')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the wall time and peak RSS of the matrix loaders')
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--cells', type=int, default=5000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--gzip', action='store_true', default=False)
+    parser.add_argument('--case', nargs=2, metavar=('LOADER', 'MATRIX'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        loader, matrix_file_path = args.case
+        with timed({'loader': loader}) as result:
+            LOADERS[loader](matrix_file_path)
+        print(json.dumps(result))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        check_parity(Path(tmp))
+        matrix_file_path = Path(tmp, 'matrix.mtx' + ('.gz' if args.gzip else ''))
+        nnz = write_matrix(matrix_file_path, args.genes, args.cells, args.density)
+        print(f'{args.genes} genes x {args.cells} cells, {nnz} non-zero entries')
+        for loader in LOADERS:
+            result = run_isolated('benchmarks.bench_load_matrix', '--case', loader, str(matrix_file_path))
+            print(f'{loader:>20}: {result["wall_time"]:8.2f}s {result["peak_rss"] / 2 ** 20:10.1f} MiB peak RSS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from hca_cellxgene.observation import Observation
+from hca_cellxgene.observation_table import ObservationTable
+
+
+def build_per_cell(obs: Observation, cell_types: list[str]) -> pd.DataFrame:
+    # The original obs layer construction in H5AD.__build_h5ad
+    obs_rows = []
+    for x in cell_types:
+        obs.__setattr__('cell_type_ontology_term_id', x)
+        obs_rows.append(obs.to_data_frame())
+    return pd.concat(obs_rows, ignore_index=True)
+
+
+def build_column_wise(obs: Observation, cell_types: list[str]) -> pd.DataFrame:
+    return ObservationTable.from_observation(obs, cell_types).to_data_frame()
+
+
+BUILDERS = {
+    'per_cell': build_per_cell,
+    'column_wise': build_column_wise,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per cell cost of building the obs layer')
+    parser.add_argument('--cells', type=int, nargs='+', default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    obs = Observation(**{
+        'sample_id': 'sample',
+        'assay_ontology_term_id': 'EFO:0009922',
+        'development_stage_ontology_term_id:human': 'HsapDv:0000087',
+        'disease_ontology_term_id': 'PATO:0000461',
+        'is_primary_data': True,
+        'organism_ontology_term_id': 'NCBITaxon:9606',
+        'sex_ontology_term_id': 'PATO:0000384',
+        'tissue_ontology_term_id': 'UBERON:0002048',
+    })
+    rng = np.random.default_rng(0)
+
+    for cells in args.cells:
+        cell_types = rng.choice(['CL:0000236', 'CL:0000084', 'CL:0000623'], size=cells).tolist()
+        results = {}
+        for name, builder in BUILDERS.items():
+            start = time.perf_counter()
+            results[name] = builder(obs, cell_types)
+            elapsed = time.perf_counter() - start
+            print(f'{cells:>9} cells {name:>12}: {elapsed:8.3f}s {elapsed / cells * 1e6:10.2f}us per cell')
+
+        # The output must not change, apart from the cell types being stored as a categorical
+        pd.testing.assert_frame_equal(results['per_cell'], results['column_wise'], check_categorical=False,
+                                      check_dtype=False)
+
+
+if __name__ == '__main__':
+    main()
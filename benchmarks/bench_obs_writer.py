@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from benchmarks.measure import run_isolated, timed
+from hca_cellxgene.helpers.constants import OBS_BATCH_SIZE
+from hca_cellxgene.helpers.obs_writer import ObsWriter
+from hca_cellxgene.observation import Observation
+from hca_cellxgene.observation_table import ObservationTable
+
+OBSERVATION = Observation(**{
+    'sample_id': 'sample',
+    'assay_ontology_term_id': 'EFO:0009922',
+    'development_stage_ontology_term_id:human': 'HsapDv:0000087',
+    'disease_ontology_term_id': 'PATO:0000461',
+    'is_primary_data': True,
+    'organism_ontology_term_id': 'NCBITaxon:9606',
+    'sex_ontology_term_id': 'PATO:0000384',
+    'tissue_ontology_term_id': 'UBERON:0002048',
+    'cell_type_ontology_term_id': 'CL:0000236',
+})
+
+
+def write_in_memory(path: Path, rows: int, batch_size: int) -> None:
+    # The original create-obs: the whole obs layer is built then written as CSV in one go
+    ObservationTable.from_observation(OBSERVATION, rows=rows).to_data_frame().to_csv(path)
+
+
+def write_batches(path: Path, rows: int, batch_size: int, output_format: str) -> None:
+    with ObsWriter(path, output_format) as writer:
+        batch = ObservationTable.from_observation(OBSERVATION, rows=min(rows, batch_size)).to_data_frame()
+        for start in range(0, rows, batch_size):
+            writer.append(batch.iloc[:min(batch_size, rows - start)])
+
+
+CASES = {
+    'in_memory_csv': (write_in_memory, 'csv'),
+    'batched_csv': (lambda *args: write_batches(*args, 'csv'), 'csv'),
+    'batched_parquet': (lambda *args: write_batches(*args, 'parquet'), 'parquet'),
+    'batched_feather': (lambda *args: write_batches(*args, 'feather'), 'feather'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the wall time, peak RSS and file size of writing obs in one '
+                                                 'go and in batches')
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--batch-size', type=int, default=OBS_BATCH_SIZE)
+    parser.add_argument('--case', nargs=2, metavar=('CASE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        case, path = args.case
+        with timed({'case': case}) as result:
+            CASES[case][0](Path(path), args.rows, args.batch_size)
+        print(json.dumps(result))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for case, (_, extension) in CASES.items():
+            path = Path(tmp, f'{case}.{extension}')
+            result = run_isolated('benchmarks.bench_obs_writer', '--rows', str(args.rows), '--batch-size',
+                                  str(args.batch_size), '--case', case, str(path))
+            print(f'{case:>16}: {result["wall_time"]:8.2f}s {result["peak_rss"] / 2 ** 20:10.1f} MiB peak RSS '
+                  f'{os.path.getsize(path) / 2 ** 20:10.1f} MiB file')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.measure import timed
+from benchmarks.synthetic import write_features, write_matrix
+from hca_cellxgene.helpers import mtx, qc
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the wall time of loading a matrix with and without computing '
+                                                 'the QC metrics of its cells')
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--cells', type=int, default=5000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        matrix_file_path = Path(tmp, 'matrix.mtx')
+        features_file_path = Path(tmp, 'features.tsv')
+        nnz = write_matrix(matrix_file_path, args.genes, args.cells, args.density)
+        write_features(features_file_path, args.genes)
+        print(f'{args.genes} genes x {args.cells} cells, {nnz} non-zero entries')
+        gene_index = pd.Index(pd.read_csv(features_file_path, sep='\t', header=None, dtype=str)[0])
+
+        load, metrics = [], []
+        for _ in range(args.repeats):
+            with timed({}) as result:
+                matrix = mtx.load_csr(matrix_file_path)
+            load.append(result['wall_time'])
+            with timed({}) as result:
+                qc.compute_qc_metrics(matrix, qc.get_mito_mask([features_file_path], gene_index))
+            metrics.append(result['wall_time'])
+
+    load_time, qc_time = min(load), min(metrics)
+    print(f'{"load":>10}: {load_time:8.3f}s')
+    print(f'{"qc":>10}: {qc_time:8.3f}s ({100 * qc_time / load_time:.1f}% of loading)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.run import get_commit
+
+COMMANDS = {
+    'create-obs': 'create_obs',
+    'create-h5ad': 'create_h5ad',
+    'create-h5ad-batch': 'create_h5ad_batch',
+    'merge-h5ad': 'merge_h5ad',
+}
+# Module each command imports once its arguments are parsed
+RUN_MODULES = {
+    'create-obs': 'obs',
+    'create-h5ad': 'H5AD',
+    'create-h5ad-batch': 'batch',
+    'merge-h5ad': 'merge',
+}
+# Modules that should only be imported by the commands that need them
+HEAVY_MODULES = ['anndata', 'scipy', 'h5py', 'requests', 'aiohttp', 'pandas']
+
+
+def parse_importtime(stderr: str) -> (dict[str, int], int):
+    # Cumulative import time in microseconds of every module from the output of python -X importtime, and the total of
+    # the modules imported at the top level. Nested imports are indented by two spaces a level.
+    cumulative = {}
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, module_total, name = line.removeprefix('import time:').split('|')
+        cumulative[name.strip()] = int(module_total)
+        if not name.startswith('  '):
+            total += int(module_total)
+    return cumulative, total
+
+
+def measure_command(command: str, env: dict, repeats: int) -> dict:
+    # Times the command's --help in a fresh interpreter, which imports everything the command imports at startup but
+    # does no work, and records which heavy modules it imported along the way
+    code = f'from hca_cellxgene.cli import {COMMANDS[command]}; {COMMANDS[command]}()'
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code, '--help'], env=env, check=True, capture_output=True)
+        wall_times.append(time.perf_counter() - start)
+
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code, '--help'], env=env, check=True,
+                            capture_output=True, text=True)
+    cumulative, import_time = parse_importtime(output.stderr)
+    # Also everything the command imports once it starts working, including what it imports lazily
+    run_code = f'import hca_cellxgene.cli; from hca_cellxgene import {RUN_MODULES[command]}'
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', run_code], env=env, check=True,
+                            capture_output=True, text=True)
+    _, run_import_time = parse_importtime(output.stderr)
+    return {
+        'wall_time': statistics.median(wall_times),
+        'import_time': import_time / 1e6,
+        'run_import_time': run_import_time / 1e6,
+        'heavy_modules': [x for x in HEAVY_MODULES if x in cumulative],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of each command')
+    parser.add_argument('--commands', nargs='+', choices=COMMANDS.keys(), default=list(COMMANDS.keys()))
+    parser.add_argument('--repeats', type=int, default=5, help='Runs of each command, the median is reported')
+    parser.add_argument('--results', type=Path, default=Path('benchmark_results.json'),
+                        help='JSON file that results are appended to')
+    args = parser.parse_args()
+
+    results = json.loads(args.results.read_text()) if args.results.exists() else []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, 'TMP_DIR': str(Path(tmp, 'work')), 'OUTPUT_PATH': str(Path(tmp, 'output'))}
+        for command in args.commands:
+            measured = measure_command(command, env, args.repeats)
+            results.append({
+                'commit': get_commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'case': f'startup:{command}',
+                **measured,
+            })
+            print(f'{command:>18}: {measured["wall_time"]:6.3f}s --help, {measured["import_time"]:6.3f}s of imports '
+                  f'at startup, {measured["run_import_time"]:6.3f}s once running. Heavy modules at startup: '
+                  f'{", ".join(measured["heavy_modules"]) or "none"}')
+        # Starting a command shouldn't create a work directory
+        if Path(tmp, 'work').exists():
+            print(f'Warning: starting a command created {list(Path(tmp, "work").iterdir())}')
+
+    args.results.write_text(json.dumps(results, indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
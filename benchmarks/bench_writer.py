@@ -0,0 +1,85 @@
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from benchmarks.measure import timed
+from hca_cellxgene.helpers.h5ad_writer import StreamingH5ADWriter
+from hca_cellxgene.helpers.writer_options import WRITER_PRESETS
+
+
+def make_matrices(matrices: int, cells: int, genes: int, density: float) -> list[sp.csr_matrix]:
+    # Integer counts stored as float32, like most contributor matrices once loaded
+    rng = np.random.default_rng(0)
+    result = []
+    for i in range(matrices):
+        matrix = sp.random(cells, genes, density=density, format='csr', dtype=np.float32, random_state=i)
+        matrix.data = rng.integers(1, 50, size=matrix.nnz).astype(np.float32)
+        result.append(matrix)
+    return result
+
+
+def make_obs(matrix: sp.csr_matrix, i: int) -> pd.DataFrame:
+    return pd.DataFrame({'cell_suspension': pd.Categorical([f'suspension_{i}'] * matrix.shape[0])},
+                        index=[f'matrix_{i}_cell_{x}' for x in range(matrix.shape[0])])
+
+
+def write_anndata(path: Path, matrices: list[sp.csr_matrix], var: pd.DataFrame) -> None:
+    # The original output path: concatenate then AnnData.write with its defaults
+    obs = pd.concat([make_obs(x, i) for i, x in enumerate(matrices)])
+    ad.AnnData(sp.vstack(matrices, format='csr'), obs, var).write(path)
+
+
+def write_preset(path: Path, matrices: list[sp.csr_matrix], var: pd.DataFrame, preset: str) -> None:
+    with StreamingH5ADWriter(path, WRITER_PRESETS[preset]) as writer:
+        for i, matrix in enumerate(matrices):
+            writer.append_matrix(matrix, make_obs(matrix, i), var)
+        writer.close({})
+
+
+def read_random_rows(path: Path, rows: int) -> float:
+    # Reads single rows at random from the file, as viewers of a backed h5ad do, and returns the time per row
+    adata = ad.read_h5ad(path, backed='r')
+    indexes = np.random.default_rng(1).integers(0, adata.n_obs, rows)
+    start = time.perf_counter()
+    for x in indexes:
+        adata.X[int(x)]
+    elapsed = time.perf_counter() - start
+    adata.file.close()
+    return elapsed / rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare write time, file size and random row reads of the writer '
+                                                 'presets with AnnData.write')
+    parser.add_argument('--matrices', type=int, default=4)
+    parser.add_argument('--cells', type=int, default=5000, help='Cells in each matrix')
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--rows', type=int, default=200, help='Random rows read from each file')
+    args = parser.parse_args()
+
+    matrices = make_matrices(args.matrices, args.cells, args.genes, args.density)
+    var = pd.DataFrame(index=pd.Index([f'gene_{x}' for x in range(args.genes)], name='gene_ids'))
+    cases = {'anndata_write': lambda path: write_anndata(path, matrices, var)}
+    cases.update({preset: lambda path, preset=preset: write_preset(path, matrices, var, preset)
+                  for preset in WRITER_PRESETS})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, write in cases.items():
+            path = Path(tmp, f'{name}.h5ad')
+            with timed({}) as result:
+                write(path)
+            read_time = read_random_rows(path, args.rows)
+            print(f'{name:>14}: {result["wall_time"]:8.2f}s write {os.path.getsize(path) / 2 ** 20:10.1f} MiB '
+                  f'{read_time * 1000:8.2f}ms per random row')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SCHEMA_BASE = 'https://schema.humancellatlas.org'
+
+
+class FakeIngest:
+    # Local stand-in for the Ingest API serving a realistic graph of one project:
+    #   donor_organism <- collection process <- specimen_from_organism <- dissociation process <- cell_suspension
+    #   cell_suspension -> sequencing process (library preparation and sequencing protocols)
+    # Only the endpoints used by IngestObservation are served: findByUuid for biomaterials and the links between
+    # entities. Each response can be delayed to mimic the latency of the real API, and every request is counted.
+    def __init__(self, donors: int = 4, specimens_per_donor: int = 3, suspensions_per_specimen: int = 5,
+                 latency: float = 0.0):
+        self.latency = latency
+        self.request_count = 0
+        self.requests_by_endpoint: dict[str, int] = {}
+        self.cell_suspension_uuids: list[str] = []
+        self.base_url = None
+
+        self.__entities: dict[str, dict] = {}
+        self.__links: dict[str, dict] = {}
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__build(donors, specimens_per_donor, suspensions_per_specimen)
+
+    def __enter__(self) -> 'FakeIngest':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.__server.server_port}'
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler) -> None:
+        url = urlparse(request.path)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        with self.__lock:
+            self.request_count += 1
+            self.requests_by_endpoint[endpoint] = self.requests_by_endpoint.get(endpoint, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if endpoint == 'findByUuid':
+            body = self.__entities.get(parse_qs(url.query).get('uuid', [''])[0])
+        else:
+            body = self.__links.get(url.path)
+
+        if body is None:
+            request.send_response(404)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        # Entities are served with a self link, so make them absolute for this server
+        content = json.dumps(body).replace('{base}', self.base_url).encode()
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/hal+json')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+    def __build(self, donors: int, specimens_per_donor: int, suspensions_per_specimen: int) -> None:
+        library_preparation = self.__entity('protocols', 'protocol', 'library_preparation_protocol', {
+            'protocol_core': {'protocol_id': 'library_preparation_1'},
+            'library_construction_method': {'text': "10x 3' v3", 'ontology': 'EFO:0009922'},
+        })
+        sequencing = self.__entity('protocols', 'protocol', 'sequencing_protocol', {
+            'protocol_core': {'protocol_id': 'sequencing_1'},
+            'instrument_manufacturer_model': {'text': 'Illumina NovaSeq 6000', 'ontology': 'EFO:0008637'},
+        })
+        collection = self.__entity('protocols', 'protocol', 'collection_protocol', {
+            'protocol_core': {'protocol_id': 'collection_1'},
+        })
+        dissociation = self.__entity('protocols', 'protocol', 'dissociation_protocol', {
+            'protocol_core': {'protocol_id': 'dissociation_1'},
+        })
+
+        for d in range(donors):
+            donor = self.__entity('biomaterials', 'type', 'donor_organism', {
+                'biomaterial_core': {'biomaterial_id': f'donor_{d}'},
+                'sex': ['male', 'female'][d % 2],
+                'genus_species': [{'text': 'Homo sapiens', 'ontology': 'NCBITaxon:9606'}],
+                'development_stage': {'text': 'adult', 'ontology': 'HsapDv:0000087'},
+                'human_specific': {'ethnicity': [{'text': 'European', 'ontology': 'HANCESTRO:0005'}]},
+            })
+
+            for s in range(specimens_per_donor):
+                specimen = self.__entity('biomaterials', 'type', 'specimen_from_organism', {
+                    'biomaterial_core': {'biomaterial_id': f'specimen_{d}_{s}'},
+                    'organ': {'text': 'lung', 'ontology': 'UBERON:0002048'},
+                    'organ_parts': [{'text': 'alveolus', 'ontology': 'UBERON:0002299'}],
+                    'diseases': [{'text': 'normal', 'ontology': 'PATO:0000461'}],
+                })
+                self.__process(specimen, [collection], [donor])
+
+                for c in range(suspensions_per_specimen):
+                    suspension = self.__entity('biomaterials', 'type', 'cell_suspension', {
+                        'biomaterial_core': {'biomaterial_id': f'cell_suspension_{d}_{s}_{c}'},
+                    })
+                    self.__process(suspension, [dissociation], [specimen])
+                    self.__link(suspension, 'inputToProcesses', 'processes', [
+                        self.__process(None, [library_preparation, sequencing], [suspension])
+                    ])
+                    self.cell_suspension_uuids.append(suspension['uuid']['uuid'])
+
+    def __entity(self, collection: str, schema_type: str, schema: str, content: dict) -> dict:
+        entity_uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, f'fake-ingest/{collection}/{len(self.__entities)}'))
+        entity = {
+            'uuid': {'uuid': entity_uuid},
+            'content': {**content, 'describedBy': f'{SCHEMA_BASE}/{schema_type}/1.0.0/{schema}'},
+            '_links': {'self': {'href': f'{{base}}/{collection}/{entity_uuid}'}},
+        }
+        self.__entities[entity_uuid] = entity
+        return entity
+
+    def __process(self, output: dict = None, protocols: list[dict] = None, inputs: list[dict] = None) -> dict:
+        process = self.__entity('processes', 'type', 'process', {'process_core': {'process_id': 'process'}})
+        self.__link(process, 'protocols', 'protocols', protocols or [])
+        self.__link(process, 'inputBiomaterials', 'biomaterials', inputs or [])
+        if output is not None:
+            self.__link(output, 'derivedByProcesses', 'processes', [process])
+        return process
+
+    def __link(self, entity: dict, link: str, embedded_key: str, targets: list[dict]) -> None:
+        path = urlparse(entity['_links']['self']['href'].replace('{base}', '')).path + f'/{link}'
+        entity['_links'][link] = {'href': f'{{base}}{path}'}
+        self.__links[path] = {'_embedded': {embedded_key: targets}}
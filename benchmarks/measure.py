@@ -0,0 +1,26 @@
+import json
+import resource
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+
+def get_peak_rss() -> int:
+    # Peak resident set size of this process in bytes (ru_maxrss is in KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def timed(result: dict):
+    start = time.perf_counter()
+    yield result
+    result['wall_time'] = time.perf_counter() - start
+    result['peak_rss'] = get_peak_rss()
+
+
+def run_isolated(module: str, *args: str) -> dict:
+    # Runs a benchmark case in a fresh interpreter so its peak RSS isn't polluted by earlier cases.
+    # The case is expected to print its result as JSON on the last line of stdout.
+    output = subprocess.run([sys.executable, '-m', module, *args], check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.fake_ingest import FakeIngest
+from benchmarks.synthetic import write_inputs
+
+SCALES = {
+    'small': {'donors': 2, 'specimens_per_donor': 2, 'suspensions_per_specimen': 2, 'matrices': 4,
+              'genes': 2000, 'cells': 500, 'density': 0.05, 'obs_rows': 10_000},
+    'medium': {'donors': 4, 'specimens_per_donor': 3, 'suspensions_per_specimen': 5, 'matrices': 16,
+               'genes': 20000, 'cells': 2000, 'density': 0.05, 'obs_rows': 1_000_000},
+    'large': {'donors': 8, 'specimens_per_donor': 5, 'suspensions_per_specimen': 10, 'matrices': 64,
+              'genes': 30000, 'cells': 5000, 'density': 0.05, 'obs_rows': 10_000_000},
+}
+
+CLI = {
+    'create-obs': 'from hca_cellxgene.cli import create_obs; create_obs()',
+    'create-h5ad': 'from hca_cellxgene.cli import create_h5ad; create_h5ad()',
+}
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_cli(command: str, args: list[str], env: dict) -> dict:
+    # Runs one of the console scripts in a fresh interpreter, measuring its wall time and the peak RSS of it and the
+    # worker processes it waits for
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', CLI[command], *args], env=env)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f'{command} {" ".join(args)} failed with exit code {os.waitstatus_to_exitcode(status)}')
+    return {'wall_time': wall_time, 'peak_rss': rusage.ru_maxrss * 1024}
+
+
+def write_create_obs_input(path: Path, cell_suspension_uuids: list[str], rows: int) -> None:
+    rng = np.random.default_rng(0)
+    pd.DataFrame({
+        'uuid': rng.choice(cell_suspension_uuids, size=rows),
+        'type': rng.choice(['CL:0000236', 'CL:0000084', 'CL:0000623'], size=rows),
+    }).to_csv(path, index=False)
+
+
+def write_create_h5ad_input(directory: Path, cell_suspension_uuids: list[str], scale: dict) -> Path:
+    rows = []
+    for i in range(scale['matrices']):
+        paths = write_inputs(directory, f'matrix_{i}', scale['genes'], scale['cells'], scale['density'], seed=i)
+        rows.append({'uuid': cell_suspension_uuids[i % len(cell_suspension_uuids)], **paths})
+    input_path = Path(directory, 'input.csv')
+    pd.DataFrame(rows).to_csv(input_path, index=False)
+    return input_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark create-obs and create-h5ad end to end against synthetic '
+                                                 'matrices and a local fake Ingest API')
+    parser.add_argument('--scale', choices=SCALES.keys(), default='small')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to each fake Ingest response')
+    parser.add_argument('--cases', nargs='+', choices=CLI.keys(), default=list(CLI.keys()))
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help='Use the Ingest response cache, warmed by an untimed first run')
+    parser.add_argument('--extra-args', type=str, default='', help='Extra arguments for create-h5ad')
+    parser.add_argument('--results', type=Path, default=Path('benchmark_results.json'),
+                        help='JSON file that results are appended to')
+    args = parser.parse_args()
+
+    scale = SCALES[args.scale]
+    results = json.loads(args.results.read_text()) if args.results.exists() else []
+
+    with tempfile.TemporaryDirectory() as tmp, FakeIngest(
+            scale['donors'], scale['specimens_per_donor'], scale['suspensions_per_specimen'], args.latency
+    ) as ingest:
+        tmp = Path(tmp)
+        Path(tmp, 'output').mkdir()
+        env = {**os.environ, 'INGEST_API': ingest.base_url, 'OUTPUT_PATH': str(Path(tmp, 'output')),
+               'TMP_DIR': str(Path(tmp, 'work'))}
+        cache_args = ['--cache-dir', str(Path(tmp, 'cache'))] if args.cache else ['--no-cache']
+        matrix_cache_args = ['--matrix-cache-dir', str(Path(tmp, 'matrix_cache'))] if args.cache else []
+
+        case_args = {}
+        if 'create-obs' in args.cases:
+            obs_input = Path(tmp, 'obs_input.csv')
+            write_create_obs_input(obs_input, ingest.cell_suspension_uuids, scale['obs_rows'])
+            case_args['create-obs'] = ['--csv', str(obs_input), *cache_args]
+        if 'create-h5ad' in args.cases:
+            h5ad_input = write_create_h5ad_input(Path(tmp, 'matrices'), ingest.cell_suspension_uuids, scale)
+            case_args['create-h5ad'] = ['--input', str(h5ad_input), '--title', 'benchmark', '--x-normalization',
+                                        'none', *cache_args, *matrix_cache_args, *args.extra_args.split()]
+
+        for case, cli_args in case_args.items():
+            if args.cache:
+                run_cli(case, cli_args, env)
+
+            requests_before = ingest.request_count
+            measured = run_cli(case, cli_args, env)
+            result = {
+                'commit': get_commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'case': case,
+                'scale': args.scale,
+                'latency': args.latency,
+                'cache': args.cache,
+                'args': cli_args,
+                **measured,
+                'http_requests': ingest.request_count - requests_before,
+            }
+            results.append(result)
+            print(f'{case:>12} [{args.scale}]: {result["wall_time"]:8.2f}s {result["peak_rss"] / 2 ** 20:10.1f} MiB '
+                  f'peak RSS {result["http_requests"]:8} HTTP requests')
+
+    args.results.write_text(json.dumps(results, indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import gzip
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def write_matrix(file_path: os.PathLike, genes: int, cells: int, density: float = 0.05, seed: int = 0) -> int:
+    # Writes a random genes x cells MatrixMarket file with integer counts, ordered by cell as 10x matrices are.
+    # The file is gzipped if the path ends in .gz. Returns the number of non-zero entries.
+    rng = np.random.default_rng(seed)
+    sampled = rng.binomial(genes * cells, density)
+    # Sorting the flattened positions orders entries by cell then gene and drops any sampled twice
+    positions = np.unique(rng.integers(0, cells, sampled, dtype=np.int64) * genes + rng.integers(0, genes, sampled))
+    cell_index = positions // genes + 1
+    gene_index = positions % genes + 1
+    counts = rng.integers(1, 50, size=len(positions))
+
+    opener = gzip.open if str(file_path).endswith('.gz') else open
+    with opener(file_path, 'wt') as f:
+        f.write('%%MatrixMarket matrix coordinate integer general\n')
+        f.write('% synthetic matrix\n')
+        f.write(f'{genes} {cells} {len(cell_index)}\n')
+        pd.DataFrame({'gene': gene_index, 'cell': cell_index, 'count': counts}).to_csv(
+            f, sep=' ', header=False, index=False
+        )
+    return len(cell_index)
+
+
+def write_barcodes(file_path: os.PathLike, cells: int) -> None:
+    with open(file_path, 'w') as f:
+        f.writelines(f'CELL{x:09d}-1\n' for x in range(cells))
+
+
+def write_features(file_path: os.PathLike, genes: int) -> None:
+    # In the layout of Cell Ranger's features.tsv: gene id, gene name and feature type. The first 13 genes are
+    # mitochondrial, as in the human genome
+    with open(file_path, 'w') as f:
+        f.writelines(f'ENSG{x:011d}\t{"MT-" if x < 13 else ""}GENE{x}\tGene Expression\n' for x in range(genes))
+
+
+def write_cell_types(file_path: os.PathLike, cells: int, cell_types: list[str] = None, seed: int = 0) -> None:
+    cell_types = cell_types or ['CL:0000236', 'CL:0000084', 'CL:0000623', 'CL:0000576']
+    rng = np.random.default_rng(seed)
+    pd.Series(rng.choice(cell_types, size=cells)).to_csv(file_path, header=False, index=False)
+
+
+def write_inputs(directory: os.PathLike, name: str, genes: int, cells: int, density: float = 0.05,
+                 seed: int = 0, compress: bool = False) -> dict:
+    # Writes a matrix with its barcodes, features and cell types, returning the paths in the shape of a create-h5ad
+    # input row
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = {
+        'matrix': Path(directory, f'{name}_matrix.mtx' + ('.gz' if compress else '')),
+        'barcodes': Path(directory, f'{name}_barcodes.tsv'),
+        'types': Path(directory, f'{name}_types.csv'),
+        'features': Path(directory, f'{name}_features.tsv'),
+    }
+    write_matrix(paths['matrix'], genes, cells, density, seed)
+    write_barcodes(paths['barcodes'], cells)
+    write_features(paths['features'], genes)
+    write_cell_types(paths['types'], cells, seed=seed)
+    return paths
@@ -1,102 +1,338 @@
+import cProfile
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import ProcessPoolExecutor
+import shutil
+import uuid
+from concurrent.futures import Future
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
 import anndata as ad
+import numpy as np
 import pandas as pd
-import scipy.io as sio
-from dotenv import load_dotenv
-from pandas import SparseDtype, DataFrame
+import scipy.sparse as sp
+from pandas import DataFrame
 
-from hca_cellxgene.observation import IngestObservation
-
-load_dotenv()
+from hca_cellxgene import context
+from hca_cellxgene.azul_manifest import AzulManifest
+from hca_cellxgene.helpers import features, handoff, mtx, qc
+from hca_cellxgene.helpers.checkpoint import CheckpointStore
+from hca_cellxgene.helpers.digests import FileDigests
+from hca_cellxgene.helpers.entity_graph import EntityGraph
+from hca_cellxgene.helpers.h5ad_writer import StreamingH5ADWriter, concat_obs
+from hca_cellxgene.helpers.matrix_cache import MatrixCache
+from hca_cellxgene.helpers.profiling import Profiler, get_peak_rss, get_profiler, save_profile, stage
+from hca_cellxgene.helpers.scheduler import MemoryAwareScheduler, create_worker_pool, estimate_matrix_memory, \
+    format_size, get_total_memory
+from hca_cellxgene.helpers.writer_options import WriterOptions
+from hca_cellxgene.obs import generate_obs, generate_obs_from_csv  # noqa: F401, kept for existing callers
+from hca_cellxgene.observation import build_observations_in_background
+from hca_cellxgene.observation_table import ObservationTable
+from hca_cellxgene.preflight import preflight
 
 
 def __load_basic_csv(file_path) -> DataFrame:
     return pd.read_csv(filepath_or_buffer=file_path, header=None)
 
 
-def __load_matrix(matrix_file_path) -> SparseDtype:
-    matrix_file = sio.mmread(matrix_file_path)
-    # Use a sparse data frame since most values are 0 and it's more efficient
-    matrix = pd.DataFrame.sparse.from_spmatrix(matrix_file)
-    return matrix.transpose()
+def __load_matrix(matrix_file_path) -> sp.csr_matrix:
+    # Matrices are genes x cells on disk, load them straight into a cells x genes CSR matrix
+    return mtx.load_csr(matrix_file_path)
+
+
+def __parse_matrix(barcodes: os.PathLike, matrix_file_path: os.PathLike, cell_types_file_path: os.PathLike,
+                   directory: os.PathLike, matrix_digest: str = None, column_map: Optional[np.ndarray] = None,
+                   n_genes: int = None, matrix_cache: MatrixCache = None, profile: bool = False,
+                   pstats_dir: os.PathLike = None) -> handoff.MatrixHandle:
+    # Doesn't need the metadata of the cell suspension, so can run while it is still being fetched
+    # Runs in a worker process, so when profiling it keeps its own profile and hands it back with the matrix
+    # Matrices that have been parsed before are taken from the matrix cache instead, without being read into memory
+    # If the matrix's genes differ from the gene index of the whole output, its columns are moved to match it
+    row = str(matrix_file_path)
+    profiler = Profiler() if profile else None
+    python_profiler = cProfile.Profile() if pstats_dir else None
+    if python_profiler:
+        python_profiler.enable()
+
+    with stage('read_cell_types', row, profiler):
+        cell_types = pd.Categorical(__load_basic_csv(cell_types_file_path)[0])
+    with stage('load_cached_matrix', row, profiler):
+        shape = matrix_cache.link(matrix_digest, directory) if matrix_cache else None
+        matrix = handoff.load_csr(directory, shape) if shape else None
+    is_saved = matrix is not None
+    if matrix is None:
+        with stage('parse_matrix', row, profiler):
+            matrix = __load_matrix(matrix_file_path)
+        if matrix_cache:
+            with stage('handoff', row, profiler):
+                handoff.save_csr(directory, matrix)
+                matrix_cache.add(matrix_digest, directory, matrix.shape)
+            is_saved = True
+    if matrix.shape[0] != len(cell_types):
+        raise ValueError(f'Matrix has {matrix.shape[0]} cells but there are {len(cell_types)} cell types')
+
+    if column_map is not None:
+        with stage('align_genes', row, profiler):
+            matrix = features.remap_columns(matrix, column_map, n_genes)
+        is_saved = False
+    if not is_saved:
+        # Hand the matrix back through memory mapped files rather than pickling it back to the parent process
+        with stage('handoff', row, profiler):
+            handoff.save_csr(directory, matrix)
+
+    if python_profiler:
+        python_profiler.disable()
+        Path(pstats_dir).mkdir(parents=True, exist_ok=True)
+        python_profiler.dump_stats(Path(pstats_dir, f'{row.strip(os.sep).replace(os.sep, "_")}.pstats'))
+    if profiler:
+        if shape is None:
+            profiler.add_bytes_read(matrix_file_path, row)
+        profiler.add_bytes_read(cell_types_file_path, row)
+        profiler.set_row_value(row, 'worker_peak_rss', get_peak_rss())
+    return handoff.MatrixHandle(str(directory), matrix.shape, matrix.nnz, cell_types,
+                                profiler.report() if profiler else None)
+
+
+def __build_h5ad(handle: handoff.MatrixHandle, obs_future: Future, row: str, var: DataFrame = None,
+                 qc_metrics: bool = False, mito_mask: Optional[np.ndarray] = None) -> ad.AnnData:
+    # Joins a parsed matrix with the metadata of its cell suspension, and its QC metrics if they are wanted
+    profiler = get_profiler()
+    if profiler and handle.profile:
+        profiler.merge(handle.profile)
+    matrix = handoff.load_csr(handle.directory, handle.shape)
+    with stage('wait_for_metadata', row):
+        obs = obs_future.result()
+    with stage('build_obs', row):
+        obs_layer = ObservationTable.from_observation(obs, handle.cell_types).to_data_frame()
+    if qc_metrics:
+        with stage('qc_metrics', row):
+            obs_layer = obs_layer.assign(**qc.compute_qc_metrics(matrix, mito_mask))
+    return ad.AnnData(matrix, obs_layer, var)
 
 
-def __build_obs_row(cell_suspension_uuid: str, cell_type: str = None) -> (str, IngestObservation):
-    logging.info(f'building obs row for {cell_suspension_uuid}')
-    return cell_suspension_uuid, IngestObservation(cell_suspension_uuid, cell_type)
+def __schedule_matrices(input_df: DataFrame, max_memory: Optional[int],
+                        matrix_cache: Optional[MatrixCache]) -> (list[int], Optional[int]):
+    # Only the header of each matrix is read, to estimate how much memory parsing it will need. Cached matrices are
+    # memory mapped rather than parsed, so need next to none
+    estimates = [
+        0 if matrix_cache and matrix_cache.get_shape(digest) else estimate_matrix_memory(mtx.read_header(x))
+        for x, digest in zip(input_df['matrix'], input_df['matrix_digest'])
+    ]
+    if max_memory is None:
+        total_memory = get_total_memory()
+        max_memory = int(total_memory * 0.8) if total_memory else None
+    logging.info(f'Estimated {format_size(sum(estimates))} to parse {len(estimates)} matrices, with a memory budget '
+                 f'of {format_size(max_memory) if max_memory else "unlimited"}.')
+    return estimates, max_memory
 
 
-def __save_obs(obs: DataFrame):
-    obs.to_csv(Path(os.environ['OUTPUT_PATH'], 'obs.csv'))
+def __align_genes(input_df: DataFrame, join: str) -> (Optional[pd.Index], list[Optional[np.ndarray]]):
+    # Builds one gene index for the whole output from the features of every matrix, and where each matrix's genes are
+    # in it. Without features matrices can only be lined up by position.
+    if 'features' not in input_df.columns:
+        return None, [None] * len(input_df)
 
+    feature_ids = {x: features.read_feature_ids(x) for x in input_df['features'].unique()}
+    gene_index = features.build_gene_index(list(feature_ids.values()), join)
+    column_maps = {x: features.get_column_map(ids, gene_index) for x, ids in feature_ids.items()}
+    logging.info(f'Aligned {len(feature_ids)} feature sets to {len(gene_index)} genes ({join})')
+    return gene_index, [column_maps[x] for x in input_df['features']]
 
-def generate_obs(uuid: str, cell_type: str = None, rows: int = 1):
-    if rows < 1:
-        raise IndexError("Rows cannot be less than 1")
-    obs = __build_obs_row(uuid, cell_type)[1]
-    if rows > 1:
-        obs = pd.concat([obs.to_data_frame()]*rows, ignore_index=True)
-    __save_obs(obs)
 
+def __concatenate(adatas: list[ad.AnnData]) -> ad.AnnData:
+    # Every matrix has the same genes in the same order by now, so they are just stacked
+    n_vars = sorted({x.n_vars for x in adatas})
+    if len(n_vars) > 1:
+        raise ValueError(f'Matrices have different numbers of genes ({", ".join(map(str, n_vars))}). Add a features '
+                         f'column to the input so their genes can be aligned')
+    matrix = sp.vstack([x.X for x in adatas], format='csr')
+    return ad.AnnData(matrix, concat_obs([x.obs for x in adatas]), adatas[0].var)
 
-def generate_obs_from_csv(input_csv: os.PathLike):
-    uuids_and_types = [(r[1]['uuid'], r[1]['type']) for r in pd.read_csv(input_csv).iterrows()]
 
-    # Build the observation layer only for unique uuids, not for each row as each uuid may be duplicated multiple times
-    # Saves network requests
-    unique_uuids = set([x[0] for x in uuids_and_types])
-    with ThreadPoolExecutor() as executor:
-        unique_obs_rows = executor.map(__build_obs_row, unique_uuids)
+def __assemble(input_df: DataFrame, pending_df: DataFrame, handles, obs_futures: dict[str, Future],
+               checkpoints: CheckpointStore, var: DataFrame = None, qc_metrics: bool = False,
+               mito_mask: Optional[np.ndarray] = None):
+    # Yields the h5ad of each input row in order. Rows that were checkpointed by an earlier run are loaded from disk,
+    # the others are joined once both their matrix and their metadata are ready, and checkpointed in turn
+    pending = zip(handles, pending_df['uuid'], pending_df['checkpoint'])
+    for row, key in zip(input_df['matrix'].astype(str), input_df['checkpoint']):
+        if checkpoints.is_complete(key):
+            with stage('load_checkpoint', row):
+                matrix, obs_layer = checkpoints.load(key)
+            yield ad.AnnData(matrix, obs_layer, var)
+            continue
 
-    # Create a hashmap for convenience in later lookup
-    unique_obs_hashmap = {x[0]: x[1] for x in unique_obs_rows}
+        handle, cell_suspension_uuid, pending_key = next(pending)
+        adata = __build_h5ad(handle, obs_futures[cell_suspension_uuid], row, var, qc_metrics, mito_mask)
+        checkpoints.save(pending_key, handle, adata.obs)
+        yield adata
 
-    # Go through each row in the original file and get the created observations
-    total_obs_rows = []
-    for uuid, cell_type in uuids_and_types:
-        obs_row = unique_obs_hashmap[uuid].set_cell_type(cell_type).to_data_frame()
-        total_obs_rows.append(obs_row)
 
-    # Build the data frame from this result
-    __save_obs(pd.concat(total_obs_rows))
+def __get_manifest_futures(azul_manifest: AzulManifest, cell_suspension_uuids: list[str]) -> dict[str, Future]:
+    # The observations of a manifest are all ready at once, as futures so they are used like those fetched from Ingest
+    futures = {}
+    for cell_suspension_uuid, observation in azul_manifest.get_observations(cell_suspension_uuids).items():
+        futures[cell_suspension_uuid] = Future()
+        futures[cell_suspension_uuid].set_result(observation)
+    return futures
 
 
-def __build_h5ad(barcodes: os.PathLike, matrix: os.PathLike, cell_types: os.PathLike,
-                 obs: IngestObservation) -> ad.AnnData:
-    cell_types = __load_basic_csv(cell_types)[0].tolist()
-    obs_rows = [obs.set_cell_type(x).to_data_frame() for x in cell_types]
-    obs_layer = pd.concat(obs_rows, ignore_index=True)
-    matrix = __load_matrix(matrix)
-    return ad.AnnData(matrix, obs_layer)
+def __select_shard(input_df: DataFrame, shard: tuple[int, int]) -> DataFrame:
+    # Shard i of N is the i-th of N contiguous blocks of rows, so merging the shards in order keeps the input order
+    index, count = shard
+    if not 0 <= index < count:
+        raise ValueError(f'Shard {index}/{count} is out of range, shards are numbered 0 to {count - 1}')
+    if count > len(input_df):
+        raise ValueError(f'Cannot split {len(input_df)} rows into {count} shards')
+    return input_df.iloc[index * len(input_df) // count:(index + 1) * len(input_df) // count]
 
 
-def generate(input_csv_path: os.PathLike, title: str, x_normalization: str):
+def preflight_input(input_csv_path: os.PathLike, entity_graph: EntityGraph = None, shard: tuple[int, int] = None,
+                    azul_manifest: AzulManifest = None) -> DataFrame:
+    # Checks the input only from the headers of the matrices, line counts and one lookup of each cell suspension,
+    # raising a PreflightError with every problem found. Every file is checked, as the genes of a shard depend on the
+    # features of all of them, but only the cell suspensions of the shard are looked up.
     input_df = pd.read_csv(input_csv_path)
+    cell_suspension_uuids = list(__select_shard(input_df, shard)['uuid'].unique()) if shard else None
+    with stage('preflight'):
+        preflight(input_df, entity_graph, cell_suspension_uuids, azul_manifest)
+    return input_df
 
-    # Build the observation layers for each cell suspension UUID in parallel to speed things up
-    # Using ThreadPool as this is an IO bound task
-    with ThreadPoolExecutor() as executor:
-        unique_obs_rows = executor.map(__build_obs_row, input_df['uuid'])
-        obs_map = {x[0]: x[1] for x in unique_obs_rows}
 
-    # Using Processes as this is a CPU bound task
-    with ProcessPoolExecutor() as executor:
-        obs_layers = (obs_map[x] for x in input_df['uuid'])
-        adatas = executor.map(__build_h5ad, input_df['barcodes'], input_df['matrix'], input_df['types'], obs_layers)
+def generate(input_csv_path: os.PathLike, title: str, x_normalization: str, low_memory: bool = False,
+             max_workers: int = None, max_memory: int = None, profile_workers: bool = False,
+             work_dir: os.PathLike = None, join: str = 'union', output_path: os.PathLike = None,
+             scheduler: MemoryAwareScheduler = None, entity_graph: EntityGraph = None, shard: tuple[int, int] = None,
+             writer_options: WriterOptions = None, azul_manifest_path: os.PathLike = None, qc_metrics: bool = False):
+    # A scheduler and entity graph can be shared by several builds running at once, so they share one pool of workers,
+    # one memory budget and every Ingest lookup. Otherwise this build gets its own.
+    # The cell suspensions looked up by the preflight are kept, so they aren't fetched again for the obs layer
+    # With a shard (i, N) only that shard of the rows is built, into a partial h5ad for merge-h5ad to combine
+    # The writer options set the compression and chunking of X in the output
+    # With an Azul manifest the obs layer is built from it, without any requests to Ingest
+    # With QC metrics obs also gets the total counts, genes detected and percentage of mitochondrial counts of each cell
+    # The hit rate of the entity graph is reported by whoever owns it, at the end of their run
+    owns_entity_graph = entity_graph is None
+    entity_graph = entity_graph if entity_graph is not None else EntityGraph()
+    with stage('read_manifest'):
+        azul_manifest = AzulManifest(azul_manifest_path) if azul_manifest_path else None
+    input_df = preflight_input(input_csv_path, entity_graph, shard, azul_manifest)
 
-    logging.info("Concatenating all h5ads into one h5ad")
-    concatenated = ad.concat(adatas)
-    concatenated.uns = {
+    # Parsed matrices are only cached if a matrix cache is configured for this run
+    matrix_cache: Optional[MatrixCache] = context.get('matrix_cache')
+
+    # Rows are checkpointed by the content of their inputs, so a re-run with the same work dir only parses the
+    # matrices and fetches the metadata of rows that are new or have changed
+    checkpoints = CheckpointStore(
+        Path(work_dir, 'checkpoints') if work_dir else Path(context['wd'], 'checkpoints', str(uuid.uuid4())),
+        FileDigests(Path(matrix_cache.directory, 'digests.json')) if matrix_cache else None
+    )
+    with stage('align_genes'):
+        gene_index, column_maps = __align_genes(input_df, join)
+    var = DataFrame(index=gene_index) if gene_index is not None else None
+    n_genes = len(gene_index) if gene_index is not None else None
+    input_df['column_map'] = pd.Series(column_maps, index=input_df.index, dtype=object)
+    # Mitochondrial genes are found by their symbols in the features, so need a gene index
+    mito_mask = None
+    if qc_metrics and gene_index is not None:
+        with stage('qc_metrics'):
+            mito_mask = qc.get_mito_mask(list(input_df['features'].unique()), gene_index)
+    elif qc_metrics:
+        logging.warning('The input has no features column, so pct_counts_mt cannot be computed')
+    # The genes are aligned across every row first, so all the shards have the same genes
+    if shard:
+        input_df = __select_shard(input_df, shard).copy()
+        logging.info(f'Building shard {shard[0]}/{shard[1]}: {len(input_df)} rows')
+
+    # Without a work dir the checkpoints only last this run, so rows are keyed by their paths rather than reading every
+    # input in full to hash it. Only the matrix cache, which is keyed by content, still needs the digests of matrices
+    with stage('hash_inputs'):
+        if work_dir:
+            # The obs of a row depends on where its metadata comes from, so rows built from Ingest aren't reused when
+            # building from a manifest, or from a different manifest, and the other way round
+            obs_source = 'ingest'
+            if azul_manifest:
+                manifest_digest = checkpoints.digests.get(azul_manifest_path)
+                obs_source = f'azul_manifest:{os.path.abspath(azul_manifest_path)}:{manifest_digest}'
+            input_df['checkpoint'] = [
+                checkpoints.key(*x, features.get_column_map_digest(column_map, n_genes),
+                                'qc_metrics' if qc_metrics else '', obs_source)
+                for *x, column_map in zip(input_df['uuid'], input_df['matrix'], input_df['types'],
+                                          input_df['column_map'])
+            ]
+        else:
+            input_df['checkpoint'] = [
+                checkpoints.path_key(*x) for x in zip(input_df['uuid'], input_df['matrix'], input_df['types'])
+            ]
+        input_df['matrix_digest'] = [checkpoints.digests.get(x) if matrix_cache else None for x in input_df['matrix']]
+        checkpoints.digests.save()
+    pending_df = input_df[~input_df['checkpoint'].map(checkpoints.is_complete)].drop_duplicates('checkpoint')
+    logging.info(f'{len(input_df) - len(pending_df)} of {len(input_df)} rows are already checkpointed in '
+                 f'{checkpoints.directory}')
+
+    with stage('read_headers'):
+        estimates, max_memory = __schedule_matrices(pending_df, max_memory, matrix_cache)
+
+    # Fetch the metadata of each cell suspension in the background while the matrices are parsed
+    if azul_manifest:
+        obs_futures = __get_manifest_futures(azul_manifest, list(pending_df['uuid'].unique()))
+    else:
+        obs_futures = build_observations_in_background(list(pending_df['uuid'].unique()), entity_graph)
+
+    uns = {
         "schema_version": os.environ.get('UNS_SCHEMA_VERSION'),
         "title": title,
         "X_normalization": x_normalization,
     }
-    output_path = Path(os.environ['OUTPUT_PATH'], 'output.h5ad')
-    concatenated.write(output_path)
-    logging.info(f"Finished generating h5ad output and written to {output_path}.")
+    output_name = f'output.shard-{shard[0]}-of-{shard[1]}.h5ad' if shard else 'output.h5ad'
+    if shard:
+        uns['shard'] = {'index': shard[0], 'count': shard[1]}
+    output_path = Path(output_path or Path(os.environ['OUTPUT_PATH'], output_name))
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    pstats_dir = output_path.with_suffix('.pstats') if profile_workers else None
 
+    # Checkpoints in a temporary directory hold full copies of the parsed matrices, so they are removed whether or not
+    # the build succeeds
+    try:
+        # Using Processes as this is a CPU bound task, scheduled so the matrices being parsed at once fit in memory
+        max_workers = max_workers or os.cpu_count() or 1
+        with nullcontext() if scheduler else create_worker_pool(max_workers, [__name__]) as executor:
+            scheduler = scheduler or MemoryAwareScheduler(executor, max_workers, max_memory)
+            parse_matrix = partial(__parse_matrix, n_genes=n_genes, matrix_cache=matrix_cache,
+                                   profile=get_profiler() is not None, pstats_dir=pstats_dir)
+            handles = scheduler.map(
+                parse_matrix, estimates, pending_df['barcodes'], pending_df['matrix'], pending_df['types'],
+                [checkpoints.get_directory(x) for x in pending_df['checkpoint']], pending_df['matrix_digest'],
+                pending_df['column_map'], names=[str(x) for x in pending_df['matrix']]
+            )
+            adatas = __assemble(input_df, pending_df, handles, obs_futures, checkpoints, var, qc_metrics, mito_mask)
+
+            if low_memory:
+                # Append each matrix to the output on disk as it finishes, so only one matrix is read into memory at
+                # once
+                logging.info("Streaming all h5ads into one h5ad")
+                with StreamingH5ADWriter(output_path, writer_options) as writer:
+                    for adata in adatas:
+                        with stage('append'):
+                            writer.append(adata)
+                    with stage('write'):
+                        writer.close(uns)
+            else:
+                logging.info("Concatenating all h5ads into one h5ad")
+                adatas = list(adatas)
+                with stage('concat'):
+                    concatenated = __concatenate(adatas)
+                with stage('write'), StreamingH5ADWriter(output_path, writer_options) as writer:
+                    writer.append(concatenated)
+                    writer.close(uns)
+    finally:
+        if not work_dir:
+            shutil.rmtree(checkpoints.directory, ignore_errors=True)
+    if matrix_cache:
+        matrix_cache.evict()
+    if owns_entity_graph and len(entity_graph):
+        logging.info(entity_graph.report())
+    save_profile(output_path)
+    logging.info(f"Finished generating h5ad output and written to {output_path}.")
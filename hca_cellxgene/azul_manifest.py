@@ -0,0 +1,129 @@
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from hca_cellxgene.observation import SEX_ONTOLOGY_TERMS, Observation
+
+SUSPENSION_COLUMN = 'cell_suspension.provenance.document_id'
+# Separates the values of a cell with more than one, e.g. the diseases of a specimen
+MULTI_VALUE_SEPARATOR = '||'
+# An ontology term id, e.g. UBERON:0002048
+ONTOLOGY_TERM_ID = re.compile(r'^[A-Za-z][A-Za-z0-9_]*:\S+$')
+
+# Columns of the manifest each obs field is read from, the first of them with a value for a cell suspension wins.
+# Ontology term id fields are only read from the ontology columns (*.ontology). Many manifests only have the labels of
+# the terms, which are not valid term ids, so those fields are left unknown rather than filled with labels. The sex is
+# the exception, as its labels map to terms. The tissue is taken from an organoid first, then a cell line, then the
+# specimen, as IngestObservation does.
+MANIFEST_FIELDS = {
+    'sample_id': ['cell_suspension.biomaterial_core.biomaterial_id'],
+    'assay_ontology_term_id': ['library_preparation_protocol.library_construction_method.ontology'],
+    'development_stage_ontology_term_id:human': ['donor_organism.development_stage.ontology'],
+    'disease_ontology_term_id': ['specimen_from_organism.diseases.ontology'],
+    'ethnicity_ontology_term_id:human': ['donor_organism.human_specific.ethnicity.ontology'],
+    'organism_ontology_term_id': ['donor_organism.genus_species.ontology'],
+    'sex_ontology_term_id': ['donor_organism.sex'],
+    'tissue_ontology_term_id': ['organoid.model_organ_part.ontology', 'organoid.model_organ.ontology',
+                                'cell_line.tissue.ontology', 'specimen_from_organism.organ_parts.ontology',
+                                'specimen_from_organism.organ.ontology'],
+}
+
+
+class ManifestObservation(Observation):
+    def __init__(self, cell_suspension_uuid: str, cell_type: str = None, **fields):
+        self.cell_suspension_uuid = cell_suspension_uuid
+        super().__init__(**fields, cell_type_ontology_term_id=cell_type, is_primary_data=True)
+
+
+class AzulManifest:
+    # Observations from a compact metadata manifest of Azul (the TSV Project._get_azul_metadata_download_link links to)
+    # instead of the Ingest API. The manifest is read once into a table of the obs fields indexed by cell suspension,
+    # each field computed for every cell suspension at once, so building obs makes no requests at all.
+    def __init__(self, manifest_path: os.PathLike):
+        self.path = manifest_path
+        columns = {SUSPENSION_COLUMN, *(x for candidates in MANIFEST_FIELDS.values() for x in candidates)}
+        manifest = pd.read_csv(manifest_path, sep='\t', dtype=str, keep_default_na=False, na_values=[''],
+                               usecols=lambda x: x in columns)
+        if SUSPENSION_COLUMN not in manifest.columns:
+            raise ValueError(f'{manifest_path} has no {SUSPENSION_COLUMN} column, is it a compact manifest?')
+        self.fields = AzulManifest.__build_fields(manifest)
+        logging.info(f'Read the metadata of {len(self.fields)} cell suspensions from {manifest_path}')
+
+    def get_missing(self, cell_suspension_uuids: list[str]) -> list[str]:
+        return [x for x in cell_suspension_uuids if x not in self.fields.index]
+
+    def get_observation(self, cell_suspension_uuid: str, cell_type: str = None) -> ManifestObservation:
+        return self.get_observations([cell_suspension_uuid], cell_type)[cell_suspension_uuid]
+
+    def get_observations(self, cell_suspension_uuids: list[str],
+                         cell_type: str = None) -> dict[str, ManifestObservation]:
+        missing = self.get_missing(cell_suspension_uuids)
+        if missing:
+            raise KeyError(f'{len(missing)} cell suspension(s) are not in the manifest {self.path}: '
+                           f'{", ".join(missing[:5])}')
+        rows = self.fields.loc[list(cell_suspension_uuids)]
+        return {
+            uuid: ManifestObservation(uuid, cell_type, **dict(zip(rows.columns, values)))
+            for uuid, values in zip(rows.index, rows.itertuples(index=False, name=None))
+        }
+
+    @staticmethod
+    def __build_fields(manifest: pd.DataFrame) -> pd.DataFrame:
+        # Each row of a manifest is a file. A file from more than one cell suspension lists all of them, and rows of a
+        # single cell suspension are preferred. Each cell suspension of a shared row keeps its position in the list
+        # and the number of suspensions listed, so its own values can be picked out of the row.
+        suspensions = manifest[SUSPENSION_COLUMN].str.split(MULTI_VALUE_SEPARATOR, regex=False)
+        manifest = manifest.assign(**{SUSPENSION_COLUMN: suspensions, '__count': suspensions.str.len()})
+        manifest = manifest.explode(SUSPENSION_COLUMN)
+        manifest['__position'] = manifest.groupby(level=0).cumcount()
+        manifest = manifest.dropna(subset=[SUSPENSION_COLUMN])
+        manifest = manifest.sort_values('__count', kind='stable').drop_duplicates(SUSPENSION_COLUMN)
+        manifest = manifest.set_index(SUSPENSION_COLUMN)
+
+        fields = pd.DataFrame(index=manifest.index)
+        for field, candidates in MANIFEST_FIELDS.items():
+            fields[field] = AzulManifest.__first_value(manifest, field, candidates)
+        fields['sex_ontology_term_id'] = fields['sex_ontology_term_id'].map(SEX_ONTOLOGY_TERMS)
+        # Missing values are None, as they are for IngestObservation
+        return fields.astype(object).where(fields.notna(), None)
+
+    @staticmethod
+    def __first_value(manifest: pd.DataFrame, field: str, candidates: list[str]) -> pd.Series:
+        # The first of the candidate columns with a value for each cell suspension
+        present = [x for x in candidates if x in manifest.columns]
+        if not present:
+            logging.warning(f'The manifest has none of the columns for {field}, so it is left unknown: '
+                            f'{", ".join(candidates)}')
+            return pd.Series(np.nan, index=manifest.index, dtype=object)
+        values = pd.DataFrame({x: AzulManifest.__suspension_values(manifest, x) for x in present})
+        values = values.bfill(axis=1).iloc[:, 0]
+        if all(x.endswith('.ontology') for x in candidates):
+            # Anything that isn't a term id, e.g. a label where a manifest has no term, is left unknown
+            is_term_id = values.str.match(ONTOLOGY_TERM_ID, na=True)
+            if not is_term_id.all():
+                logging.warning(f'{(~is_term_id).sum()} cell suspension(s) have values for {field} that are not '
+                                f'ontology term ids, e.g. {values[~is_term_id].iloc[0]}, which are left unknown')
+                values = values.where(is_term_id)
+        return values
+
+    @staticmethod
+    def __suspension_values(manifest: pd.DataFrame, column: str) -> pd.Series:
+        # The value of a column for each cell suspension. In a row of one cell suspension with more than one value the
+        # first is used, as IngestObservation does. In a shared row a single value is shared by every cell suspension,
+        # and otherwise each cell suspension takes the value at its position if there is one value per suspension.
+        # Any other shared value can't be attributed to a cell suspension, so it is left unknown.
+        split = manifest[column].str.split(MULTI_VALUE_SEPARATOR, regex=False)
+        counts = split.str.len()
+        is_own = (manifest['__count'] > 1) & (counts == manifest['__count'])
+        is_ambiguous = (manifest['__count'] > 1) & (counts > 1) & ~is_own
+        positions = manifest['__position'].where(is_own, 0)
+        values = pd.Series([x[i] if isinstance(x, list) else np.nan for x, i in zip(split, positions)],
+                           index=manifest.index, dtype=object)
+        if is_ambiguous.any():
+            logging.warning(f'{is_ambiguous.sum()} cell suspension(s) are only in manifest rows shared with other cell '
+                            f'suspensions whose {column} values cannot be matched to them, which are left unknown')
+            values = values.where(~is_ambiguous)
+        return values
@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+
+from hca_cellxgene import H5AD
+from hca_cellxgene.helpers.entity_graph import EntityGraph
+from hca_cellxgene.helpers.scheduler import MemoryAwareScheduler, create_worker_pool, format_size, get_total_memory
+
+MANIFEST_COLUMNS = ['input', 'title', 'x_normalization', 'output']
+
+
+class BatchStatus:
+    # Status and timing of every job of a batch, rewritten to a JSON file whenever a job starts or finishes so a
+    # long batch can be followed while it runs
+    def __init__(self, path: os.PathLike, jobs: list[dict]):
+        self.path = Path(path)
+        self.jobs = [{**x, 'status': 'pending'} for x in jobs]
+        self.__lock = threading.Lock()
+        self.__write()
+
+    def start(self, i: int) -> None:
+        self.__update(i, status='running', started_at=datetime.now(timezone.utc).isoformat())
+
+    def finish(self, i: int, wall_time: float, error: Exception = None) -> None:
+        self.__update(
+            i, status='failed' if error else 'succeeded', finished_at=datetime.now(timezone.utc).isoformat(),
+            wall_time=wall_time, error=repr(error) if error else None
+        )
+
+    def count(self, status: str) -> int:
+        return sum(x['status'] == status for x in self.jobs)
+
+    def __update(self, i: int, **values) -> None:
+        with self.__lock:
+            self.jobs[i].update(values)
+            self.__write()
+
+    def __write(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(f'{self.path}.tmp')
+        temp_path.write_text(json.dumps(self.jobs, indent=2, default=str))
+        os.replace(temp_path, self.path)
+
+
+def read_manifest(manifest_path: os.PathLike) -> list[dict]:
+    manifest = pd.read_csv(manifest_path)
+    missing = [x for x in MANIFEST_COLUMNS if x not in manifest.columns]
+    if missing:
+        raise IOError(f'Manifest {manifest_path} is missing the column(s) {", ".join(missing)}')
+
+    # Outputs are relative to OUTPUT_PATH, like the output of a single build
+    output_dir = Path(os.environ.get('OUTPUT_PATH', 'output'))
+    jobs = []
+    for x in manifest[MANIFEST_COLUMNS].itertuples(index=False):
+        jobs.append({'name': str(x.output).replace(os.sep, '_'), 'input': str(x.input), 'title': x.title,
+                     'x_normalization': x.x_normalization, 'output': str(Path(output_dir, x.output))})
+    outputs = [x['output'] for x in jobs]
+    if len(set(outputs)) != len(outputs):
+        raise IOError(f'Manifest {manifest_path} writes more than one job to the same output')
+    return jobs
+
+
+def generate_batch(manifest_path: os.PathLike, status_path: os.PathLike = None, max_jobs: int = 4,
+                   max_workers: int = None, max_memory: int = None, work_dir: os.PathLike = None, **options) -> None:
+    # Builds every h5ad of a manifest in one process. Jobs run on threads, several at once, and share one pool of
+    # worker processes with one memory budget for parsing matrices, and one entity graph so cell suspensions,
+    # specimens and donors shared between datasets are only looked up once.
+    jobs = read_manifest(manifest_path)
+    status = BatchStatus(status_path or Path(os.environ.get('OUTPUT_PATH', 'output'), 'batch_status.json'), jobs)
+    entity_graph = EntityGraph()
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_memory is None:
+        total_memory = get_total_memory()
+        max_memory = int(total_memory * 0.8) if total_memory else None
+    logging.info(f'Running {len(jobs)} jobs, {max_jobs} at once, on {max_workers} workers with a memory budget of '
+                 f'{format_size(max_memory) if max_memory else "unlimited"}')
+
+    def run(i: int, job: dict):
+        status.start(i)
+        start = time.perf_counter()
+        try:
+            H5AD.generate(
+                job['input'], job['title'], job['x_normalization'], max_workers=max_workers,
+                work_dir=Path(work_dir, job['name']) if work_dir else None, output_path=job['output'],
+                scheduler=scheduler, entity_graph=entity_graph, **options
+            )
+        except Exception as e:
+            logging.exception(f'Job {i} ({job["input"]}) failed')
+            status.finish(i, time.perf_counter() - start, e)
+        else:
+            status.finish(i, time.perf_counter() - start)
+            logging.info(f'Job {i} ({job["input"]}) finished in {time.perf_counter() - start:.1f}s')
+
+    with create_worker_pool(max_workers, [H5AD.__name__]) as executor, ThreadPoolExecutor(max_jobs) as jobs_executor:
+        scheduler = MemoryAwareScheduler(executor, max_workers, max_memory)
+        for future in [jobs_executor.submit(run, i, x) for i, x in enumerate(jobs)]:
+            future.result()
+
+    logging.info(entity_graph.report())
+    if status.count('failed'):
+        raise RuntimeError(f'{status.count("failed")} of {len(jobs)} jobs failed, see {status.path}')
@@ -3,18 +3,104 @@ import logging
 import os
 from pathlib import Path
 
-from dotenv import load_dotenv
-
-from hca_cellxgene import H5AD
+from hca_cellxgene import context
+from hca_cellxgene.helpers.cache import EntityCache
+from hca_cellxgene.helpers.constants import JOINS, OBS_BATCH_SIZE, OBS_FORMATS
+from hca_cellxgene.helpers.profiling import Profiler
+from hca_cellxgene.helpers.utils import parse_shard, parse_size
+from hca_cellxgene.helpers.writer_options import COMPRESSIONS, WRITER_PRESETS, WriterOptions, get_writer_options
 
 logging.basicConfig()
 logger = logging.getLogger()
 
-load_dotenv()
+# Each command imports what it needs when it runs, so a command only pays for importing its own dependencies. create-obs
+# is run once per cell suspension from shell loops, where importing anndata and scipy would dominate
+
+
+def __add_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--cache-dir', type=str, help='Directory of the persistent cache of Ingest API responses',
+                        default=Path(os.environ.get('TMP_DIR', 'tmp'), 'cache'))
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Do not read from or write to the cache of Ingest API responses')
+    parser.add_argument('--refresh-cache', action='store_true', default=False,
+                        help='Ignore cached Ingest API responses, and cached matrices if there is a matrix cache, and '
+                             'replace them with fresh ones')
+
+
+def __configure_cache(args: argparse.Namespace):
+    if args.no_cache:
+        context['cache'] = None
+        return
+
+    ttl = os.environ.get('CACHE_TTL')
+    max_size = os.environ.get('CACHE_MAX_SIZE')
+    context['cache'] = EntityCache(
+        args.cache_dir,
+        ttl=float(ttl) if ttl else None,
+        max_size=int(max_size) if max_size else None,
+        refresh=args.refresh_cache
+    )
+
+
+def __add_matrix_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--matrix-cache-dir', type=str,
+                        help='Directory to cache parsed matrices in, so rebuilding from the same matrices skips parsing '
+                             'them. Each cached matrix is a full binary copy, limited in total to '
+                             'MATRIX_CACHE_MAX_SIZE bytes. Off unless given')
+
+
+def __configure_matrix_cache(args: argparse.Namespace):
+    if not args.matrix_cache_dir:
+        context['matrix_cache'] = None
+        return
+
+    from hca_cellxgene.helpers.matrix_cache import MatrixCache
+    max_size = os.environ.get('MATRIX_CACHE_MAX_SIZE')
+    context['matrix_cache'] = MatrixCache(
+        args.matrix_cache_dir,
+        refresh=args.refresh_cache,
+        max_size=int(max_size) if max_size else None
+    )
+
+
+def __add_profile_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Write a JSON report of the time spent in each stage, Ingest API requests, bytes read and '
+                             'peak memory next to the output')
+
+
+def __add_writer_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--writer-preset', choices=WRITER_PRESETS.keys(), default='default',
+                        help='Compression and chunking of X in the output h5ad: default (uncompressed, like '
+                             'AnnData.write), fast (lzf), balanced (gzip 4) or small (gzip 6 with bigger chunks). '
+                             'The other writer arguments override the preset')
+    parser.add_argument('--compression', choices=COMPRESSIONS, help='Compression of X in the output h5ad')
+    parser.add_argument('--compression-level', type=int, help='gzip compression level, 0 to 9')
+    parser.add_argument('--chunk-size', type=int,
+                        help='Entries in each HDF5 chunk of X. Larger chunks compress better, smaller chunks make '
+                             'reading random rows faster')
+    parser.add_argument('--compression-threads', type=int, help='Threads compressing chunks of X while the next '
+                                                                'matrix is encoded')
+    parser.add_argument('--no-categorical-obs', action='store_true', default=False,
+                        help='Keep string columns of obs as strings rather than storing them as categoricals')
+
+
+def __get_writer_options(args: argparse.Namespace) -> WriterOptions:
+    return get_writer_options(
+        args.writer_preset, compression=args.compression, compression_level=args.compression_level,
+        chunk_size=args.chunk_size, compression_threads=args.compression_threads,
+        categorical_obs=False if args.no_categorical_obs else None
+    )
+
+
+def __add_azul_manifest_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--azul-manifest', type=str,
+                        help='Compact metadata manifest TSV of the project from Azul. The obs layer is built from it '
+                             'instead of the Ingest API, without any requests')
 
 
 def create_obs():
-    parser = argparse.ArgumentParser(description='Create a CSV file for the obs layer of an h5ad file')
+    parser = argparse.ArgumentParser(description='Create a file for the obs layer of an h5ad file')
     parser.add_argument('--uuid', help='Cell suspension UUID', type=str)
     parser.add_argument('--type', help='Cell type', type=str)
     parser.add_argument('--rows', help='Count of the number of rows in output CSV. The row will be duplicated '
@@ -22,42 +108,157 @@ def create_obs():
     parser.add_argument('--debug', action='store_true', default=False)
     parser.add_argument('--csv', help="CSV of header 'uuid, type'. Each row will map to one row in the output h5ad."
                                       "Use instead of uuid, type, and rows flag")
+    parser.add_argument('--output-format', choices=OBS_FORMATS, default='csv',
+                        help='Format of the output. parquet and feather keep the columns dictionary encoded and need '
+                             'pyarrow')
+    parser.add_argument('--batch-size', type=int, default=OBS_BATCH_SIZE,
+                        help='Rows read, built and written at once, which bounds the memory used')
+    __add_azul_manifest_argument(parser)
+    __add_cache_arguments(parser)
+    __add_profile_arguments(parser)
 
     args = parser.parse_args()
 
     if args.debug:
         logger.setLevel(logging.INFO)
+    __configure_cache(args)
+    context['profiler'] = Profiler() if args.profile else None
+    from hca_cellxgene import obs
 
     if args.csv and (args.type or args.uuid):
         raise IOError("You cannot use the CSV argument as well as type and uuid.")
     if args.csv:
-        H5AD.generate_obs_from_csv(args.csv)
+        obs.generate_obs_from_csv(args.csv, args.azul_manifest, args.output_format, args.batch_size)
         return
 
     if not args.csv and not (args.type and args.uuid):
         raise IOError("If you are not using CSV argument you must specify at least uuid and type.")
-    H5AD.generate_obs(args.uuid, args.type, args.rows)
+    obs.generate_obs(args.uuid, args.type, args.rows, args.azul_manifest, args.output_format, args.batch_size)
 
 
 def create_h5ad():
-    parser = argparse.ArgumentParser(description='Create a CSV file for the obs layer of an h5ad file')
+    parser = argparse.ArgumentParser(description='Create an h5ad file from contributor matrices and Ingest metadata')
     parser.add_argument('--input', type=str, help='CSV of HCA cell suspension UUIDs and associated matrix file, '
                                                   'barcodes file, and cell type on each row. Expects first row to be '
                                                   'header row of "uuid", "matrix", "type", "barcodes"',
                         required=True)
-    parser.add_argument('--title', type=str, required=True, help="Title for the uns layer")
-    parser.add_argument('--x-normalization', type=str, required=True, help="Type of normalization. Used in uns layer")
-    parser.add_argument(
-        '-o', '--output', type=str, help='Output file', default=Path(os.environ.get('OUTPUT_PATH', 'output'), 'obs.csv')
+    # Required unless only running the preflight checks
+    parser.add_argument('--title', type=str, help="Title for the uns layer")
+    parser.add_argument('--x-normalization', type=str, help="Type of normalization. Used in uns layer")
+    parser.add_argument('-o', '--output', type=str,
+                        help='Output h5ad. Defaults to output.h5ad, or output.shard-i-of-N.h5ad with --shard, in '
+                             'OUTPUT_PATH')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='Append each matrix to the output h5ad as it finishes instead of concatenating them all '
+                             'in memory. Peak memory is bounded by the largest matrices rather than the whole project')
+    parser.add_argument('--workers', type=int, help='Maximum number of matrices to parse at once. Defaults to the '
+                                                    'number of CPUs')
+    parser.add_argument('--max-memory', type=parse_size, help='Memory budget for parsing matrices, e.g. 16G. Matrices '
+                                                              'are only parsed at the same time if their estimated '
+                                                              'memory fits. Defaults to 80%% of the total memory')
+    parser.add_argument('--join', choices=JOINS, default='union',
+                        help='Genes to keep when the input has a features column and matrices have different genes: '
+                             'those in any matrix (union) or only those in every matrix (intersection)')
+    parser.add_argument('--preflight', action='store_true', default=False,
+                        help='Only check the input, without parsing any matrices. The same checks run before every '
+                             'build')
+    parser.add_argument('--work-dir', type=str, help='Directory to keep per-row checkpoints in. Re-running with the '
+                                                     'same directory only processes rows that are new or changed')
+    parser.add_argument('--qc-metrics', action='store_true', default=False,
+                        help='Add the total counts, genes detected and percentage of mitochondrial counts of each cell '
+                             'to obs, as total_counts, n_genes_by_counts and pct_counts_mt')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Only build shard i/N of the rows, e.g. 0/4, into output.shard-i-of-N.h5ad in '
+                             'OUTPUT_PATH. Shards are numbered from 0 and combined with merge-h5ad')
+    parser.add_argument('--debug', action='store_true', default=False)
+    __add_azul_manifest_argument(parser)
+    __add_cache_arguments(parser)
+    __add_matrix_cache_arguments(parser)
+    __add_writer_arguments(parser)
+    __add_profile_arguments(parser)
+    parser.add_argument('--profile-workers', action='store_true', default=False,
+                        help='Also dump cProfile stats of each matrix parsed by the worker processes. Implies '
+                             '--profile')
+
+    args = parser.parse_args()
+    missing = [name for name, value in [('--title', args.title), ('--x-normalization', args.x_normalization)]
+               if value is None]
+    if missing and not args.preflight:
+        parser.error(f'the following arguments are required: {", ".join(missing)}')
+
+    if args.debug:
+        logger.setLevel(logging.INFO)
+    __configure_cache(args)
+    __configure_matrix_cache(args)
+    context['profiler'] = Profiler() if args.profile or args.profile_workers else None
+    from hca_cellxgene import H5AD
+    from hca_cellxgene.azul_manifest import AzulManifest
+
+    if args.preflight:
+        azul_manifest = AzulManifest(args.azul_manifest) if args.azul_manifest else None
+        H5AD.preflight_input(args.input, azul_manifest=azul_manifest)
+        logger.info(f'{args.input} passed preflight checks')
+        return
+
+    H5AD.generate(args.input, args.title, args.x_normalization, low_memory=args.low_memory,
+                  max_workers=args.workers, max_memory=args.max_memory, profile_workers=args.profile_workers,
+                  work_dir=args.work_dir, join=args.join, shard=args.shard, writer_options=__get_writer_options(args),
+                  azul_manifest_path=args.azul_manifest, qc_metrics=args.qc_metrics, output_path=args.output)
+
+
+def create_h5ad_batch():
+    parser = argparse.ArgumentParser(
+        description='Create many h5ad files in one run, sharing workers and Ingest lookups'
     )
+    parser.add_argument('--manifest', type=str, required=True,
+                        help='CSV of jobs with the header row "input", "title", "x_normalization", "output". Each '
+                             'input is a create-h5ad input CSV, and each output a path relative to OUTPUT_PATH')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of h5ad files to build at once')
+    parser.add_argument('--status', type=str, help='JSON file the status and timing of each job is written to. '
+                                                   'Defaults to batch_status.json in OUTPUT_PATH')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='Append each matrix to its output h5ad as it finishes, as in create-h5ad')
+    parser.add_argument('--workers', type=int, help='Maximum number of matrices to parse at once, across every job. '
+                                                    'Defaults to the number of CPUs')
+    parser.add_argument('--max-memory', type=parse_size, help='Memory budget for parsing matrices across every job, '
+                                                              'e.g. 16G. Defaults to 80%% of the total memory')
+    parser.add_argument('--join', choices=JOINS, default='union',
+                        help='Genes to keep when matrices have different genes, as in create-h5ad')
+    parser.add_argument('--work-dir', type=str, help='Directory to keep per-row checkpoints of every job in')
     parser.add_argument('--debug', action='store_true', default=False)
+    __add_cache_arguments(parser)
+    __add_matrix_cache_arguments(parser)
+    __add_writer_arguments(parser)
 
     args = parser.parse_args()
 
     if args.debug:
         logger.setLevel(logging.INFO)
+    __configure_cache(args)
+    __configure_matrix_cache(args)
+    from hca_cellxgene import batch
+
+    batch.generate_batch(args.manifest, status_path=args.status, max_jobs=args.jobs, max_workers=args.workers,
+                         max_memory=args.max_memory, work_dir=args.work_dir, low_memory=args.low_memory,
+                         join=args.join, writer_options=__get_writer_options(args))
+
 
-    H5AD.generate(args.input, args.title, args.x_normalization)
+def merge_h5ad():
+    parser = argparse.ArgumentParser(description='Merge the shards of an h5ad built with create-h5ad --shard')
+    parser.add_argument('shards', nargs='+', help='Every shard h5ad, in any order')
+    parser.add_argument(
+        '-o', '--output', type=str, help='Output file',
+        default=Path(os.environ.get('OUTPUT_PATH', 'output'), 'output.h5ad')
+    )
+    parser.add_argument('--debug', action='store_true', default=False)
+    __add_writer_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.INFO)
+    from hca_cellxgene import merge
+    merge.merge_shards(args.shards, args.output, writer_options=__get_writer_options(args))
 
 
 if __name__ == "__main__":
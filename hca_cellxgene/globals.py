@@ -1,17 +1,32 @@
 import os
+import threading
 import uuid
 from pathlib import Path
 
 from dotenv import load_dotenv
 
+# The only place .env is loaded. Every module is imported through the package, so it is loaded before any of them read
+# the environment
 load_dotenv()
 
-wd = Path(os.environ.get('TMP_DIR', 'tmp'), str(uuid.uuid4()))
-wd.mkdir(parents=True)
+
+class Context(dict):
+    # The work directory is only created the first time it is used, so importing the package or running a command
+    # that doesn't need one leaves nothing behind
+    __lock = threading.Lock()
+
+    def __missing__(self, key):
+        if key != 'wd':
+            raise KeyError(key)
+        with Context.__lock:
+            if 'wd' not in self:
+                wd = Path(os.environ.get('TMP_DIR', 'tmp'), str(uuid.uuid4()))
+                wd.mkdir(parents=True)
+                self['wd'] = wd
+            return dict.__getitem__(self, 'wd')
+
 
 # Just a global dict to access runtime context
 # Can use something like Context Locals if we support multithreading in the future
 # https://werkzeug.palletsprojects.com/en/2.0.x/local/
-context = {
-    'wd': wd
-}
+context = Context()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+class EntityCache:
+    # Persistent cache of Ingest API responses that survives between runs.
+    # Entries are content addressed by the sha256 of the request URL and stored in a single SQLite file so it can be
+    # shared safely by the threads that build observations.
+    # Entries older than the TTL are not served directly, but keep their ETag so they can be revalidated cheaply.
+    # The total size of the stored responses is bounded by evicting the least recently used entries.
+    def __init__(self, cache_dir: Path, ttl: Optional[float] = None, max_size: Optional[int] = None,
+                 refresh: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(Path(self.cache_dir, 'entities.sqlite3'), check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS entities ('
+            'key TEXT PRIMARY KEY, url TEXT, etag TEXT, body TEXT, size INTEGER, stored_at REAL, accessed_at REAL)'
+        )
+        self.__connection.execute('CREATE INDEX IF NOT EXISTS entities_accessed_at ON entities (accessed_at)')
+        self.__connection.commit()
+        self.__size = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM entities').fetchone()[0]
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def get(self, url: str) -> Optional[dict]:
+        # Only returns entries that are still fresh
+        entry = self.get_entry(url)
+        if not entry or not entry[2]:
+            return None
+        return entry[0]
+
+    def get_entry(self, url: str) -> Optional[tuple[dict, Optional[str], bool]]:
+        # Returns the (value, etag, is_fresh) of a cached entry, even if it has expired, so it can be revalidated
+        if self.refresh:
+            return None
+
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT body, etag, stored_at FROM entities WHERE key = ?', (EntityCache.key(url),)
+            ).fetchone()
+            if not row:
+                return None
+            self.__connection.execute(
+                'UPDATE entities SET accessed_at = ? WHERE key = ?', (time.time(), EntityCache.key(url))
+            )
+            self.__connection.commit()
+
+        body, etag, stored_at = row
+        is_fresh = self.ttl is None or time.time() - stored_at < self.ttl
+        return json.loads(body), etag, is_fresh
+
+    def set(self, url: str, value: dict, etag: Optional[str] = None) -> None:
+        body = json.dumps(value)
+        now = time.time()
+        key = EntityCache.key(url)
+
+        with self.__lock:
+            previous = self.__connection.execute('SELECT size FROM entities WHERE key = ?', (key,)).fetchone()
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO entities (key, url, etag, body, size, stored_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, url, etag, body, len(body), now, now)
+            )
+            self.__size += len(body) - (previous[0] if previous else 0)
+            self.__evict()
+            self.__connection.commit()
+
+    def touch(self, url: str) -> None:
+        # Marks an expired entry as fresh again, e.g. after the server has told us it has not been modified
+        now = time.time()
+        with self.__lock:
+            self.__connection.execute(
+                'UPDATE entities SET stored_at = ?, accessed_at = ? WHERE key = ?', (now, now, EntityCache.key(url))
+            )
+            self.__connection.commit()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+    def __evict(self) -> None:
+        if self.max_size is None or self.__size <= self.max_size:
+            return
+
+        evicted = 0
+        rows = self.__connection.execute('SELECT key, size FROM entities ORDER BY accessed_at').fetchall()
+        for key, size in rows:
+            if self.__size <= self.max_size:
+                break
+            self.__connection.execute('DELETE FROM entities WHERE key = ?', (key,))
+            self.__size -= size
+            evicted += 1
+        logging.info(f'Evicted {evicted} least recently used entries from the entity cache.')
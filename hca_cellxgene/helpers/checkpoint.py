@@ -0,0 +1,59 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+import scipy.sparse as sp
+
+from hca_cellxgene.helpers import handoff
+from hca_cellxgene.helpers.digests import FileDigests
+from hca_cellxgene.helpers.utils import read_json_file, write_json_file
+
+
+class CheckpointStore:
+    # Per-row checkpoints of an h5ad build, so a failed or extended run only has to process new or changed rows.
+    # Each row is a directory named by the content hash of its matrix and cell types files and its cell suspension
+    # UUID. It holds the parsed matrix in the handoff format, the pickled obs layer and a manifest. The manifest is
+    # written last, so a row only counts as done once everything needed to rebuild it is on disk.
+    def __init__(self, directory: os.PathLike, digests: FileDigests = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.digests = digests or FileDigests(Path(self.directory, 'digests.json'))
+
+    def key(self, cell_suspension_uuid: str, matrix_file_path: os.PathLike, cell_types_file_path: os.PathLike,
+            *extra: str) -> str:
+        # Anything else the row's artefacts depend on, such as how its genes are aligned, can be passed as extra
+        h = hashlib.sha256(cell_suspension_uuid.encode())
+        h.update(self.digests.get(matrix_file_path).encode())
+        h.update(self.digests.get(cell_types_file_path).encode())
+        for x in extra:
+            h.update(x.encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def path_key(cell_suspension_uuid: str, matrix_file_path: os.PathLike, cell_types_file_path: os.PathLike) -> str:
+        # For checkpoints that only last one run, during which the files don't change. Keyed by the paths of the files
+        # rather than their content, so they don't have to be read in full to hash them
+        return hashlib.sha256('\0'.join([cell_suspension_uuid, str(matrix_file_path),
+                                          str(cell_types_file_path)]).encode()).hexdigest()
+
+    def get_directory(self, key: str) -> Path:
+        return Path(self.directory, key)
+
+    def is_complete(self, key: str) -> bool:
+        return Path(self.get_directory(key), 'checkpoint.json').exists()
+
+    def save(self, key: str, handle: handoff.MatrixHandle, obs: pd.DataFrame) -> None:
+        # The matrix has already been written to the row's directory by the worker that parsed it
+        directory = self.get_directory(key)
+        obs.to_pickle(Path(directory, 'obs.pkl'))
+        manifest_path = Path(directory, 'checkpoint.json')
+        write_json_file(f'{manifest_path}.part', {'shape': list(handle.shape), 'nnz': handle.nnz})
+        os.replace(f'{manifest_path}.part', manifest_path)
+        logging.info(f'Checkpointed {handle.shape[0]} cells to {directory}')
+
+    def load(self, key: str) -> (sp.csr_matrix, pd.DataFrame):
+        directory = self.get_directory(key)
+        shape = tuple(read_json_file(str(Path(directory, 'checkpoint.json')))['shape'])
+        return handoff.load_csr(directory, shape), pd.read_pickle(Path(directory, 'obs.pkl'))
@@ -0,0 +1,9 @@
+# Choices and defaults the CLI offers. Kept free of dependencies so the CLI can build its arguments without importing
+# pandas, scipy or h5py
+
+# Genes kept in the output when matrices have different genes
+JOINS = ['union', 'intersection']
+# Formats create-obs can write obs as. parquet and feather keep obs dictionary encoded and need pyarrow
+OBS_FORMATS = ['csv', 'parquet', 'feather']
+# Rows of obs create-obs builds and writes at once, which bounds its memory however many rows there are
+OBS_BATCH_SIZE = 2 ** 20
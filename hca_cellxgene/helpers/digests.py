@@ -0,0 +1,42 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+class FileDigests:
+    # sha256 of input files, remembered by path, size and modification time so unchanged files aren't hashed again.
+    # Hashing a large matrix is much cheaper than parsing it, but still not free.
+    def __init__(self, path: os.PathLike):
+        self.path = Path(path)
+        self.__lock = threading.Lock()
+        try:
+            self.__digests = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.__digests = {}
+
+    def get(self, file_path: os.PathLike) -> str:
+        stat = os.stat(file_path)
+        path = str(Path(file_path).resolve())
+        with self.__lock:
+            known = self.__digests.get(path)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+
+        h = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        with self.__lock:
+            self.__digests[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': h.hexdigest()}
+        return h.hexdigest()
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with self.__lock:
+            temp_path.write_text(json.dumps(self.__digests))
+        os.replace(temp_path, self.path)
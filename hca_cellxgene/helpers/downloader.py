@@ -0,0 +1,214 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+CHUNK_SIZE = 2 ** 20  # 1 Mebibyte
+MIN_SEGMENT_SIZE = 2 ** 24  # 16 Mebibytes
+# Progress of each segment is saved every this many chunks, so an interrupted download can be resumed
+SAVE_EVERY = 16
+CHECKSUM_ALGORITHMS = {'md5', 'sha1', 'sha256'}
+
+
+class Downloader:
+    # Downloads files over a pool of keep-alive connections shared by every download of the run.
+    # If the server supports HTTP Range requests, large files are split into segments that are downloaded in parallel
+    # and written in place into a .part file. The progress of each segment is kept next to it so an interrupted download
+    # resumes where it stopped instead of starting over. Completed files are verified against the checksums the server
+    # provides, or the ones given by the caller.
+    def __init__(self, segments: int = 4, min_segment_size: int = MIN_SEGMENT_SIZE, chunk_size: int = CHUNK_SIZE,
+                 max_retries: int = 5, timeout: float = 60):
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['GET', 'HEAD'])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(segments, 10), max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def download(self, url: str, download_path: os.PathLike, checksums: dict[str, str] = None) -> Path:
+        download_path = Path(download_path)
+        download_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = Path(f'{download_path}.part')
+        state_path = Path(f'{download_path}.json')
+
+        # A one byte range request tells us the size of the file, whether it can be downloaded in segments and
+        # whether it changed since a previous attempt. If ranges aren't supported the response is the whole file.
+        probe = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=self.timeout)
+        if probe.status_code == 416:
+            probe.close()
+            probe = self.session.get(url, stream=True, timeout=self.timeout)
+        probe.raise_for_status()
+
+        size = Downloader.__get_size(probe)
+        validator = probe.headers.get('ETag') or probe.headers.get('Last-Modified')
+        checksums = {**Downloader.get_checksums(probe), **(checksums or {})}
+        state = Downloader.__read_state(state_path)
+        if state and (state['size'] != size or state['validator'] != validator):
+            logging.info(f'{url} has changed since it was last downloaded, starting over')
+            state = None
+
+        if state and state.get('complete') and download_path.exists():
+            probe.close()
+            logging.info(f'Already downloaded {url} to {download_path}')
+            return download_path
+
+        try:
+            if probe.status_code == 206 and size:
+                probe.close()
+                if not state or not part_path.exists():
+                    state = {'size': size, 'validator': validator, 'segments': self.__split(size)}
+                self.__download_segments(url, part_path, state, state_path)
+            else:
+                # No ranges, so nothing to resume from
+                state = {'size': size, 'validator': validator, 'segments': []}
+                self.__download_stream(probe, part_path, size)
+        finally:
+            probe.close()
+
+        Downloader.verify(part_path, checksums)
+        os.replace(part_path, download_path)
+        Downloader.__write_state(state_path, {**state, 'complete': True})
+        return download_path
+
+    def __split(self, size: int) -> list[list[int]]:
+        # Each segment is [start, end, bytes done], with end inclusive as in the Range header
+        count = max(1, min(self.segments, size // self.min_segment_size))
+        bounds = [size * i // count for i in range(count + 1)]
+        return [[bounds[i], bounds[i + 1] - 1, 0] for i in range(count)]
+
+    def __download_segments(self, url: str, part_path: Path, state: dict, state_path: Path) -> None:
+        done = sum(x[2] for x in state['segments'])
+        if done:
+            logging.info(f'Resuming download of {url} from {done} of {state["size"]} bytes')
+
+        lock = threading.Lock()
+        progress_bar = tqdm(total=state['size'], initial=done, unit='iB', unit_scale=True)
+
+        def save_state():
+            with lock:
+                Downloader.__write_state(state_path, state)
+
+        def download_segment(segment: list[int]):
+            attempt = 0
+            since_saved = 0
+            while segment[0] + segment[2] <= segment[1]:
+                headers = {'Range': f'bytes={segment[0] + segment[2]}-{segment[1]}'}
+                try:
+                    with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise IOError(f'Expected a partial response for {headers["Range"]} of {url}, got '
+                                          f'{r.status_code}')
+                        for data in r.iter_content(self.chunk_size):
+                            os.pwrite(fd, data, segment[0] + segment[2])
+                            segment[2] += len(data)
+                            with lock:
+                                progress_bar.update(len(data))
+                            since_saved += 1
+                            if since_saved >= SAVE_EVERY:
+                                save_state()
+                                since_saved = 0
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout):
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        raise
+                    logging.info(f'Retrying {headers["Range"]} of {url} (attempt {attempt} of {self.max_retries})')
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+        try:
+            os.ftruncate(fd, state['size'])
+            with ThreadPoolExecutor(len(state['segments'])) as executor:
+                for future in [executor.submit(download_segment, x) for x in state['segments']]:
+                    future.result()
+        finally:
+            # Whatever made it to disk is kept, so the download can resume from there
+            os.close(fd)
+            save_state()
+            progress_bar.close()
+
+    def __download_stream(self, response: requests.Response, part_path: Path, size: Optional[int]) -> None:
+        progress_bar = tqdm(total=size, unit='iB', unit_scale=True)
+        try:
+            with open(part_path, 'wb') as f:
+                for data in response.iter_content(self.chunk_size):
+                    f.write(data)
+                    progress_bar.update(len(data))
+            if size and progress_bar.n != size:
+                raise IOError(f'Expected {size} bytes from {response.url} but got {progress_bar.n}')
+        finally:
+            progress_bar.close()
+
+    @staticmethod
+    def __read_state(state_path: Path) -> Optional[dict]:
+        try:
+            return json.loads(state_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def __write_state(state_path: Path, state: dict) -> None:
+        # Replaced atomically so an interrupted run never leaves a torn state file behind
+        temp_path = Path(f'{state_path}.tmp')
+        temp_path.write_text(json.dumps(state))
+        os.replace(temp_path, state_path)
+
+    @staticmethod
+    def __get_size(response: requests.Response) -> Optional[int]:
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        if match:
+            return int(match.group(1))
+        length = response.headers.get('Content-Length')
+        return int(length) if length and response.status_code == 200 else None
+
+    @staticmethod
+    def get_checksums(response: requests.Response) -> dict[str, str]:
+        # Hex digests of the whole file from the headers servers commonly send them in. Headers of partial responses
+        # may describe only the range, so only Google's x-goog-hash, which is always of the whole object, is used then.
+        checksums = {}
+        headers = response.headers
+        digests = [x.strip().split('=', 1) for x in headers.get('x-goog-hash', '').split(',') if '=' in x]
+        if response.status_code == 200:
+            digests += [x.strip().split('=', 1) for x in headers.get('Digest', '').split(',') if '=' in x]
+            if headers.get('Content-MD5'):
+                digests.append(['md5', headers['Content-MD5']])
+        for algorithm, value in digests:
+            algorithm = algorithm.lower().replace('-', '')
+            if algorithm in CHECKSUM_ALGORITHMS:
+                checksums[algorithm] = base64.b64decode(value).hex()
+        return checksums
+
+    @staticmethod
+    def verify(file_path: os.PathLike, checksums: dict[str, str]) -> None:
+        if not checksums:
+            return
+        hashes = {algorithm: hashlib.new(algorithm) for algorithm in checksums}
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                for h in hashes.values():
+                    h.update(block)
+        for algorithm, h in hashes.items():
+            if h.hexdigest() != checksums[algorithm].lower():
+                os.remove(file_path)
+                raise IOError(f'{algorithm} of {file_path} was {h.hexdigest()}, expected {checksums[algorithm]}')
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+
+
+class EntityGraph:
+    # Run scoped, thread safe store of the Ingest entities and links fetched while building observations.
+    # Cell suspensions from the same project share specimens, donors and the processes between them so each href is
+    # only fetched once, even if several threads ask for it at the same time.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entities: dict[str, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.cached = 0
+
+    async def aget(self, href: str, fetch: Callable[[str], Awaitable[dict]]) -> dict:
+        # Fetches the href only if no one else has, waiting for fetches that are in-flight elsewhere without blocking
+        # the event loop
+        future, is_owner = self.__claim(href)
+        if is_owner:
+            try:
+                future.set_result(await fetch(href))
+            except asyncio.CancelledError as e:
+                # Don't leave anyone else waiting on a fetch that will never finish
+                self.__fail(href, future, e)
+                raise
+            except Exception as e:
+                self.__fail(href, future, e)
+
+        return await asyncio.wrap_future(future)
+
+    def __claim(self, href: str) -> (Future, bool):
+        with self.__lock:
+            future = self.__entities.get(href)
+            if future is None:
+                future = Future()
+                self.__entities[href] = future
+                self.misses += 1
+                return future, True
+
+            self.hits += 1
+            return future, False
+
+    def record_cached(self) -> None:
+        # Called by the fetcher when a miss was served from the persistent cache rather than downloaded from Ingest
+        with self.__lock:
+            self.cached += 1
+
+    def __fail(self, href: str, future: Future, e: BaseException) -> None:
+        # Forget about the failure so that a later request can try again
+        with self.__lock:
+            del self.__entities[href]
+        future.set_exception(e)
+
+    def __len__(self) -> int:
+        return len(self.__entities)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self) -> str:
+        # Logged at the end of a run by its owner
+        return f'Entity graph: {self.hits + self.misses} lookups, {self.misses - self.cached} downloaded, ' \
+               f'{self.cached} from the persistent cache, {self.hits} shared ({self.hit_rate:.1%} hit rate)'
@@ -0,0 +1,71 @@
+import hashlib
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from hca_cellxgene.helpers import mtx
+from hca_cellxgene.helpers.constants import JOINS
+
+
+def read_feature_ids(features_file_path: os.PathLike) -> np.ndarray:
+    # Only the first column, the gene ids, is read from features.tsv (or genes.tsv from older versions of Cell Ranger)
+    with mtx.open_text(features_file_path) as f:
+        ids = pd.read_csv(f, sep='\t', header=None, usecols=[0], dtype=str)[0]
+    return ids.to_numpy()
+
+
+def build_gene_index(feature_ids: list[np.ndarray], join: str = 'union') -> pd.Index:
+    # One index for the genes of every matrix. The union keeps genes in the order they are first seen, the
+    # intersection keeps the order of the first matrix.
+    if join not in JOINS:
+        raise ValueError(f'Unknown join {join}, expected one of {", ".join(JOINS)}')
+    if join == 'union':
+        return pd.Index(pd.unique(np.concatenate(feature_ids)), name='gene_ids')
+
+    genes = pd.Index(pd.unique(feature_ids[0]))
+    for ids in feature_ids[1:]:
+        genes = genes[genes.isin(ids)]
+    return pd.Index(genes, name='gene_ids')
+
+
+def get_column_map(feature_ids: np.ndarray, gene_index: pd.Index) -> Optional[np.ndarray]:
+    # Position of each of a matrix's genes in the gene index, or -1 if it isn't in it. None if the matrix already has
+    # exactly the genes of the index, in the same order, so needs no remapping.
+    if len(feature_ids) == len(gene_index) and np.array_equal(feature_ids, gene_index.to_numpy()):
+        return None
+    return gene_index.get_indexer(feature_ids).astype(np.int64)
+
+
+def get_column_map_digest(column_map: Optional[np.ndarray], n_genes: int) -> str:
+    if column_map is None:
+        return ''
+    h = hashlib.sha256(str(n_genes).encode())
+    h.update(column_map.tobytes())
+    return h.hexdigest()
+
+
+def remap_columns(matrix: sp.csr_matrix, column_map: np.ndarray, n_genes: int) -> sp.csr_matrix:
+    # Moves every entry to its gene's column in the gene index without densifying, dropping genes that aren't in it
+    columns = column_map[matrix.indices]
+    keep = columns >= 0
+    if keep.all():
+        # Sorting the columns is done in place, so memory mapped data has to be copied first
+        data = matrix.data if matrix.data.flags.writeable else matrix.data.copy()
+        indices, indptr = columns, matrix.indptr
+    else:
+        # Each row loses the entries it had in dropped genes
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+        data, indices, indptr = matrix.data[keep], columns[keep], kept_before[matrix.indptr]
+
+    index_dtype = np.int32 if max(n_genes, len(data)) < np.iinfo(np.int32).max else np.int64
+    remapped = sp.csr_matrix(
+        (data, indices.astype(index_dtype), np.asarray(indptr).astype(index_dtype)),
+        shape=(matrix.shape[0], n_genes), copy=False
+    )
+    # Sorts the columns of each row back into order, and adds up genes that appeared more than once in the features
+    remapped.has_canonical_format = False
+    remapped.sum_duplicates()
+    return remapped
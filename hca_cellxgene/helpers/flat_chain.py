@@ -6,7 +6,9 @@ class FlatChain:
     # Each value in the chain has a 'child_key' which is the key for another value in the dict
     # Constraint: only one link of each key value
     # Enables faster look ups than a normal linked list
+    # Values are shallow copied on the way in, as the same entity may be shared by the chains of several observations
     def __init__(self, root_key, root_value):
+        root_value = dict(root_value)
         self.__chain = {
             root_key: root_value
         }
@@ -17,6 +19,7 @@ class FlatChain:
         if key in self.__chain:
             raise KeyError("Key already exists in chain")
 
+        value = dict(value)
         value['parent_key'] = self.__last_key
         self.__chain[key] = value
         self.__chain[self.__last_key]['child_key'] = key
@@ -40,7 +43,7 @@ class FlatChain:
         if key not in self.__chain:
             raise KeyError("Key not in chain")
 
-        self.__chain[key] = value
+        self.__chain[key] = dict(value)
         return self
 
     def next(self) -> 'FlatChain':
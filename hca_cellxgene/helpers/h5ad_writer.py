@@ -0,0 +1,197 @@
+import logging
+import os
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from pandas import DataFrame
+
+from hca_cellxgene.helpers.writer_options import WriterOptions
+
+try:
+    from anndata.io import write_elem
+except ImportError:
+    from anndata.experimental import write_elem
+
+
+def concat_obs(frames: list[DataFrame]) -> DataFrame:
+    # pd.concat turns categoricals with different categories into object columns, which costs far more memory than
+    # the codes. Union the categories instead so every column stays dictionary encoded.
+    columns = {}
+    for column in frames[0].columns:
+        values = [x[column] for x in frames]
+        if all(isinstance(x.dtype, pd.CategoricalDtype) for x in values):
+            columns[column] = pd.api.types.union_categoricals(values)
+        else:
+            columns[column] = np.concatenate([x.to_numpy() for x in values])
+    index = np.concatenate([x.index.astype(str).to_numpy() for x in frames])
+    return pd.DataFrame(columns, index=pd.Index(index))
+
+
+class ChunkedAppender:
+    # Appends to a 1-d chunked dataset a whole chunk at a time, on background threads so writing overlaps with the
+    # caller encoding the next matrix. gzip chunks are deflated with zlib, which releases the GIL, on several threads at
+    # once and written straight to the file with write_direct_chunk, skipping HDF5's own filter pipeline. Other
+    # compressions are left to HDF5.
+    def __init__(self, dataset: h5py.Dataset, options: WriterOptions, executor: ThreadPoolExecutor):
+        self.dataset = dataset
+        self.length = 0
+        self.__written = 0
+        self.__buffer: list[np.ndarray] = []
+        self.__buffered = 0
+        self.__chunk_size = options.chunk_size
+        self.__level = options.compression_level if options.compression_level is not None else 4
+        self.__direct = options.compression == 'gzip'
+        self.__executor = executor
+        # Bounds the chunks waiting to be written, and so the memory they hold
+        self.__pending: deque[Future] = deque()
+        self.__max_pending = 2 * max(1, options.compression_threads)
+
+    def append(self, values: np.ndarray) -> None:
+        self.__buffer.append(values)
+        self.__buffered += len(values)
+        self.length += len(values)
+        if self.__buffered >= self.__chunk_size:
+            self.__write_chunks(final=False)
+
+    def flush(self) -> None:
+        # Writes the last, partial chunk and waits for every chunk to be written
+        if self.__buffered:
+            self.__write_chunks(final=True)
+        while self.__pending:
+            self.__pending.popleft().result()
+
+    def __write_chunks(self, final: bool) -> None:
+        # Copied, so the chunks don't depend on the arrays they came from once append returns
+        values = np.concatenate(self.__buffer).astype(self.dataset.dtype, copy=False)
+        end = len(values) if final else len(values) // self.__chunk_size * self.__chunk_size
+        self.dataset.resize((self.__written + end,))
+        for start in range(0, end, self.__chunk_size):
+            self.__submit(self.__written + start, values[start:min(start + self.__chunk_size, end)])
+        self.__written += end
+        self.__buffer = [values[end:]]
+        self.__buffered = len(values) - end
+
+    def __submit(self, offset: int, chunk: np.ndarray) -> None:
+        while len(self.__pending) >= self.__max_pending:
+            self.__pending.popleft().result()
+        self.__pending.append(self.__executor.submit(self.__write_chunk, offset, chunk))
+
+    def __write_chunk(self, offset: int, chunk: np.ndarray) -> None:
+        if not self.__direct:
+            self.dataset[offset:offset + len(chunk)] = chunk
+            return
+        # A direct chunk is always a whole chunk, the part past the end of the dataset is never read
+        if len(chunk) < self.__chunk_size:
+            chunk = np.concatenate([chunk, np.zeros(self.__chunk_size - len(chunk), dtype=chunk.dtype)])
+        self.dataset.id.write_direct_chunk((offset,), zlib.compress(chunk.tobytes(), self.__level))
+
+
+def strings_to_categoricals(obs: DataFrame) -> DataFrame:
+    # String columns with repeated values are stored as categoricals, as AnnData.write does
+    obs = obs.copy()
+    for column in obs.columns:
+        values = obs[column]
+        if pd.api.types.is_object_dtype(values) and pd.api.types.infer_dtype(values) == 'string' and \
+                values.nunique() < len(values):
+            obs[column] = values.astype('category')
+    return obs
+
+
+class StreamingH5ADWriter:
+    # Writes an h5ad file one AnnData at a time, so that only the matrix being appended needs to be in memory.
+    # X is written as a CSR matrix whose data, indices and indptr datasets grow with each append. The obs layers are
+    # kept as (categorical) data frames, which are small next to X, and written with var and uns when closed.
+    # The compression and chunking of X are set by the writer options, and chunks are written on background threads.
+    # The file is written to <path>.part and only moved onto the path once closed, so a build that fails part way
+    # through leaves no truncated file behind and doesn't destroy the output of an earlier run.
+    def __init__(self, path: os.PathLike, options: WriterOptions = None):
+        self.path = path
+        self.part_path = f'{path}.part'
+        self.options = options or WriterOptions()
+        self.n_obs = 0
+        self.n_vars: Optional[int] = None
+        self.nnz = 0
+        self.__obs: list[DataFrame] = []
+        self.__var: Optional[DataFrame] = None
+        self.__executor = ThreadPoolExecutor(max(1, self.options.compression_threads))
+
+        self.__file = h5py.File(self.part_path, 'w')
+        self.__file.attrs['encoding-type'] = 'anndata'
+        self.__file.attrs['encoding-version'] = '0.1.0'
+        self.__x = self.__file.create_group('X')
+        self.__x.attrs['encoding-type'] = 'csr_matrix'
+        self.__x.attrs['encoding-version'] = '0.1.0'
+        self.__data: Optional[ChunkedAppender] = None
+        self.__indices = self.__create_dataset('indices', np.int32)
+        self.__indptr = self.__create_dataset('indptr', np.int64)
+        self.__indptr.append(np.zeros(1, dtype=np.int64))
+
+    def __enter__(self) -> 'StreamingH5ADWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.__executor.shutdown(cancel_futures=True)
+        if self.__file.id.valid:
+            self.__file.close()
+        # Left behind if the writer wasn't closed, i.e. the build failed
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def append(self, adata: ad.AnnData) -> None:
+        self.append_matrix(adata.X, adata.obs, adata.var)
+
+    def append_matrix(self, matrix, obs: DataFrame, var: DataFrame) -> None:
+        # Appends the cells of a matrix with their obs rows. The var of the first matrix is the var of the output.
+        matrix = matrix if sp.issparse(matrix) and matrix.format == 'csr' else sp.csr_matrix(matrix)
+        if not matrix.has_canonical_format:
+            # Sorted indices without duplicates, which readers of CSR matrices expect
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+        if self.n_vars is None:
+            self.n_vars = matrix.shape[1]
+            self.__var = var
+            self.__data = self.__create_dataset('data', matrix.dtype)
+        elif matrix.shape[1] != self.n_vars:
+            raise ValueError(f'Cannot append a matrix of {matrix.shape[1]} genes to one of {self.n_vars} genes')
+
+        nnz = matrix.nnz
+        self.__data.append(matrix.data)
+        self.__indices.append(matrix.indices)
+        self.__indptr.append(matrix.indptr[1:].astype(np.int64) - matrix.indptr[0] + self.nnz)
+        self.nnz += nnz
+        self.n_obs += matrix.shape[0]
+        self.__obs.append(obs)
+        logging.info(f'Appended {matrix.shape[0]} cells to {self.path}, {self.n_obs} cells so far.')
+
+    def close(self, uns: dict = None) -> None:
+        if self.n_vars is None:
+            raise IndexError("Cannot write an h5ad file without any matrices")
+
+        for dataset in [self.__data, self.__indices, self.__indptr]:
+            dataset.flush()
+        self.__executor.shutdown()
+        self.__x.attrs['shape'] = (self.n_obs, self.n_vars)
+        obs = concat_obs(self.__obs)
+        write_elem(self.__file, 'obs', strings_to_categoricals(obs) if self.options.categorical_obs else obs)
+        write_elem(self.__file, 'var', self.__var)
+        write_elem(self.__file, 'uns', uns or {})
+        for key in ['obsm', 'varm', 'obsp', 'varp', 'layers']:
+            write_elem(self.__file, key, {})
+        self.__file.close()
+        os.replace(self.part_path, self.path)
+        logging.info(f'Finished writing {self.n_obs} cells x {self.n_vars} genes to {self.path}.')
+
+    def __create_dataset(self, name: str, dtype) -> ChunkedAppender:
+        compression = None if self.options.compression == 'none' else self.options.compression
+        dataset = self.__x.create_dataset(
+            name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(self.options.chunk_size,),
+            compression=compression, compression_opts=self.options.compression_level if compression == 'gzip' else None
+        )
+        return ChunkedAppender(dataset, self.options, self.__executor)
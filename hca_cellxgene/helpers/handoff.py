@@ -0,0 +1,36 @@
+import os
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+CSR_ARRAYS = ['data', 'indices', 'indptr']
+
+
+class MatrixHandle(NamedTuple):
+    # Small descriptor of a matrix a worker process has written to disk. Returned to the parent process instead of
+    # the matrix itself so that it does not have to be pickled and piped back.
+    directory: str
+    shape: tuple[int, int]
+    nnz: int
+    cell_types: pd.Categorical
+    # Report of the worker's profiler, if the run is being profiled
+    profile: Optional[dict] = None
+
+
+def save_csr(directory: os.PathLike, matrix: sp.csr_matrix) -> None:
+    # Each array of the CSR matrix is written as a raw .npy file so it can be memory mapped when loaded
+    # Existing files are unlinked rather than overwritten, as they may be hard links into the matrix cache
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for name in CSR_ARRAYS:
+        Path(directory, f'{name}.npy').unlink(missing_ok=True)
+        np.save(Path(directory, f'{name}.npy'), getattr(matrix, name))
+
+
+def load_csr(directory: os.PathLike, shape: tuple[int, int], mmap_mode: str = 'r') -> sp.csr_matrix:
+    # Attaches to the arrays written by save_csr without reading them into memory. Pages are only read from disk
+    # when the matrix is used, e.g. when it is appended to the output.
+    arrays = [np.load(Path(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in CSR_ARRAYS]
+    return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
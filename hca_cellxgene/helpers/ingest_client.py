@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from typing import Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+from hca_cellxgene import context
+from hca_cellxgene.helpers.entity_graph import EntityGraph
+from hca_cellxgene.helpers.profiling import get_profiler
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HostRateLimiter:
+    # Spaces out the start of requests to a single host so that we never exceed the given requests per second
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.__next_at = 0.0
+        self.__lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self.__lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.__next_at - now
+            self.__next_at = max(now, self.__next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AsyncIngestClient:
+    # Async client used to traverse the Ingest API graph.
+    # Requests share one pool of keep-alive connections and the number of requests in-flight at once is bounded.
+    # Responses are looked up in the run's entity graph and then the persistent cache (if configured) before the
+    # network, and requests that fail with 429 or 5xx are retried with jittered exponential backoff.
+    def __init__(self, entity_graph: EntityGraph = None, max_in_flight: int = None, rate_limit: float = None,
+                 max_retries: int = None, backoff: float = 0.5, max_backoff: float = 30.0):
+        self.entity_graph = entity_graph if entity_graph is not None else EntityGraph()
+        self.max_in_flight = max_in_flight or int(os.environ.get('INGEST_MAX_IN_FLIGHT', 16))
+        self.rate_limit = rate_limit or float(os.environ.get('INGEST_RATE_LIMIT', 0))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get('INGEST_MAX_RETRIES', 5))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__rate_limiters: dict[str, HostRateLimiter] = {}
+
+    async def __aenter__(self) -> 'AsyncIngestClient':
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=30)
+        self.__session = aiohttp.ClientSession(connector=connector, raise_for_status=False)
+        self.__semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.__session.close()
+        self.__session = None
+
+    async def get(self, url: str) -> dict:
+        return await self.entity_graph.aget(url, self.__get_cached)
+
+    async def __get_cached(self, url: str) -> dict:
+        # Look up the response in the persistent cache first, if one has been configured for this run
+        cache = context.get('cache')
+        entry = cache.get_entry(url) if cache else None
+        if entry and entry[2]:
+            self.entity_graph.record_cached()
+            return entry[0]
+
+        # Revalidate an expired entry so we only download the entity again if it has changed
+        headers = {'If-None-Match': entry[1]} if entry and entry[1] else {}
+        status, result, etag = await self.__fetch(url, headers)
+        if status == 304:
+            cache.touch(url)
+            self.entity_graph.record_cached()
+            return entry[0]
+
+        if cache:
+            cache.set(url, result, etag)
+        return result
+
+    async def __fetch(self, url: str, headers: dict) -> (int, Optional[dict], Optional[str]):
+        attempt = 0
+        while True:
+            await self.__wait_for_host(url)
+            async with self.__semaphore:
+                try:
+                    async with self.__session.get(url, headers=headers) as r:
+                        if r.status not in RETRY_STATUSES or attempt >= self.max_retries:
+                            r.raise_for_status()
+                            body = await r.read() if r.status != 304 else b''
+                            AsyncIngestClient.__record(url, len(body))
+                            return r.status, json.loads(body) if body else None, r.headers.get('ETag')
+                        retry_after = r.headers.get('Retry-After')
+                        reason = f'status {r.status}'
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    retry_after = None
+                    reason = repr(e)
+
+            delay = self.__get_backoff(attempt, retry_after)
+            attempt += 1
+            logging.info(f'Retrying {url} in {delay:.2f}s after {reason} (attempt {attempt} of {self.max_retries})')
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def get_request_type(url: str) -> str:
+        # The type of entity requested, e.g. biomaterials for findByUuid lookups or the link followed, such as protocols
+        path = urlparse(url).path.rstrip('/').split('/')
+        return path[-3] if path[-1] == 'findByUuid' and len(path) >= 3 else path[-1]
+
+    @staticmethod
+    def __record(url: str, response_bytes: int) -> None:
+        profiler = get_profiler()
+        if profiler:
+            profiler.add_http(AsyncIngestClient.get_request_type(url), response_bytes)
+
+    def __get_backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        # Full jitter so that many requests failing together don't all retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def __wait_for_host(self, url: str) -> None:
+        if not self.rate_limit:
+            return
+        host = urlparse(url).netloc
+        if host not in self.__rate_limiters:
+            self.__rate_limiters[host] = HostRateLimiter(self.rate_limit)
+        await self.__rate_limiters[host].wait()
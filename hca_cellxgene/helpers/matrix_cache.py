@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from hca_cellxgene.helpers import handoff
+
+
+class MatrixCache:
+    # Persistent cache of parsed matrices, so rebuilding an h5ad from the same contributor matrices skips parsing the
+    # text MatrixMarket files. Entries are keyed by the sha256 of the source file and hold the CSR arrays in the
+    # handoff format, so they are memory mapped when loaded rather than read into memory.
+    # Entries are never modified once written, so they are shared with the directories matrices are handed off in by
+    # hard links instead of copies where the file system allows it.
+    # Each entry is a full binary copy of a matrix, so the cache is limited to max_size bytes, evicting the least
+    # recently used entries first.
+    def __init__(self, directory: os.PathLike, refresh: bool = False, max_size: Optional[int] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.refresh = refresh
+        self.max_size = max_size
+
+    def get_shape(self, digest: str) -> Optional[tuple[int, int]]:
+        if self.refresh:
+            return None
+        try:
+            return tuple(json.loads(Path(self.directory, digest, 'shape.json').read_text()))
+        except (OSError, ValueError):
+            return None
+
+    def link(self, digest: str, directory: os.PathLike) -> Optional[tuple[int, int]]:
+        # Puts the cached arrays of a matrix in the given directory, returning its shape, or None if it isn't cached
+        shape = self.get_shape(digest)
+        if shape is None:
+            return None
+        try:
+            MatrixCache.__link_arrays(Path(self.directory, digest), directory)
+            # The modification time of an entry is when it was last used
+            os.utime(Path(self.directory, digest))
+        except OSError as e:
+            logging.info(f'Could not use cached matrix {digest}: {e}')
+            return None
+        return shape
+
+    def add(self, digest: str, directory: os.PathLike, shape: tuple[int, int]) -> None:
+        # Adds the arrays of a parsed matrix in the given directory to the cache. The entry is assembled under a
+        # temporary name and renamed into place, so concurrent workers never see a partial entry.
+        temp_dir = Path(self.directory, f'{digest}.{uuid.uuid4()}.tmp')
+        entry_dir = Path(self.directory, digest)
+        try:
+            MatrixCache.__link_arrays(directory, temp_dir)
+            Path(temp_dir, 'shape.json').write_text(json.dumps(list(shape)))
+            if self.refresh:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another worker cached the same matrix first
+            pass
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def evict(self) -> None:
+        # Removes the least recently used entries until the cache fits in max_size
+        if self.max_size is None:
+            return
+        entries = []
+        for entry_dir in self.directory.iterdir():
+            if not entry_dir.is_dir() or entry_dir.suffix == '.tmp':
+                continue
+            try:
+                size = sum(x.stat().st_size for x in entry_dir.iterdir())
+                entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+            except OSError:
+                # Removed by another build evicting at the same time
+                continue
+        size = sum(x[1] for x in entries)
+        for _, entry_size, entry_dir in sorted(entries):
+            if size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            size -= entry_size
+            logging.info(f'Evicted cached matrix {entry_dir.name} ({entry_size} bytes)')
+
+    @staticmethod
+    def __link_arrays(source_dir: os.PathLike, target_dir: os.PathLike) -> None:
+        Path(target_dir).mkdir(parents=True, exist_ok=True)
+        for name in handoff.CSR_ARRAYS:
+            source, target = Path(source_dir, f'{name}.npy'), Path(target_dir, f'{name}.npy')
+            target.unlink(missing_ok=True)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
@@ -0,0 +1,133 @@
+import gzip
+import os
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+import scipy.sparse as sp
+
+CHUNK_SIZE = 1_000_000
+
+DATA_TYPES = {
+    'integer': np.int64,
+    'real': np.float64,
+    'pattern': np.float64,
+}
+
+
+class MatrixMarketHeader(NamedTuple):
+    rows: int
+    columns: int
+    nnz: int
+    format: str
+    field: str
+    symmetry: str
+    # Count of lines before the first entry, including the banner, comments and size line
+    header_lines: int
+
+
+def is_gzip(file_path: os.PathLike) -> bool:
+    # Goes by the content of the file rather than the extension
+    with open(file_path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_text(file_path: os.PathLike):
+    # Opens a plain text or gzipped file
+    return gzip.open(file_path, 'rt') if is_gzip(file_path) else open(file_path, 'r')
+
+
+def open_binary(file_path: os.PathLike):
+    return gzip.open(file_path, 'rb') if is_gzip(file_path) else open(file_path, 'rb')
+
+
+def read_header(matrix_file_path: os.PathLike) -> MatrixMarketHeader:
+    # Only reads the banner, comments and size line so is cheap no matter how big the matrix is
+    with open_text(matrix_file_path) as f:
+        banner = f.readline().split()
+        if len(banner) != 5 or banner[0] != '%%MatrixMarket':
+            raise ValueError(f'{matrix_file_path} is not a MatrixMarket file')
+        header_lines = 1
+
+        line = f.readline()
+        while line.startswith('%') or not line.strip():
+            if not line:
+                raise ValueError(f'{matrix_file_path} has no size line')
+            header_lines += 1
+            line = f.readline()
+        header_lines += 1
+
+    _, _, matrix_format, field, symmetry = [x.lower() for x in banner]
+    size = [int(x) for x in line.split()]
+    if matrix_format == 'coordinate':
+        rows, columns, nnz = size
+    else:
+        rows, columns = size
+        nnz = rows * columns
+    return MatrixMarketHeader(rows, columns, nnz, matrix_format, field, symmetry, header_lines)
+
+
+def get_index_dtype(header: MatrixMarketHeader) -> type:
+    # int32 indices halve the memory of the matrix structure as long as they can address every entry
+    return np.int32 if max(header.rows, header.columns, header.nnz) < np.iinfo(np.int32).max else np.int64
+
+
+def load_csr(matrix_file_path: os.PathLike, chunk_size: int = CHUNK_SIZE) -> sp.csr_matrix:
+    # Loads a genes x cells MatrixMarket file as a cells x genes CSR matrix.
+    # Entries are streamed in chunks into arrays sized from the header, rather than going through a COO matrix and a
+    # sparse DataFrame. When the entries are ordered by cell, as 10x matrices are, the CSR matrix is built in place.
+    header = read_header(matrix_file_path)
+    if header.format != 'coordinate' or header.symmetry != 'general' or header.field not in DATA_TYPES:
+        # Uncommon layouts are left to scipy
+        return sp.csr_matrix(sio.mmread(matrix_file_path).T)
+
+    index_dtype = get_index_dtype(header)
+    shape = (header.columns, header.rows)
+    if header.nnz == 0:
+        # e.g. a cell suspension with no cells passing filter. There are no entries for read_csv to read
+        return sp.csr_matrix(shape, dtype=DATA_TYPES[header.field])
+    cells = np.empty(header.nnz, dtype=index_dtype)
+    genes = np.empty(header.nnz, dtype=index_dtype)
+    data = np.ones(header.nnz, dtype=DATA_TYPES[header.field])
+
+    is_pattern = header.field == 'pattern'
+    reader = pd.read_csv(
+        matrix_file_path, sep=r'\s+', header=None, comment='%', skiprows=header.header_lines,
+        usecols=[0, 1] if is_pattern else [0, 1, 2], chunksize=chunk_size,
+        compression='gzip' if is_gzip(matrix_file_path) else None, float_precision='round_trip',
+        dtype={0: index_dtype, 1: index_dtype, 2: DATA_TYPES[header.field]}
+    )
+
+    offset = 0
+    is_sorted_by_cell = True
+    last_cell = -1
+    for chunk in reader:
+        end = offset + len(chunk)
+        if end > header.nnz:
+            raise ValueError(f'{matrix_file_path} has more entries than the {header.nnz} in its header')
+
+        # MatrixMarket is 1-indexed
+        np.subtract(chunk[0].to_numpy(), 1, out=genes[offset:end])
+        np.subtract(chunk[1].to_numpy(), 1, out=cells[offset:end])
+        if not is_pattern:
+            data[offset:end] = chunk[2].to_numpy()
+
+        chunk_cells = cells[offset:end]
+        if is_sorted_by_cell and len(chunk_cells):
+            is_sorted_by_cell = chunk_cells[0] >= last_cell and bool(np.all(chunk_cells[1:] >= chunk_cells[:-1]))
+            last_cell = chunk_cells[-1]
+        offset = end
+
+    if offset != header.nnz:
+        raise ValueError(f'{matrix_file_path} has {offset} entries but its header says {header.nnz}')
+
+    if not is_sorted_by_cell:
+        return sp.coo_matrix((data, (cells, genes)), shape=shape).tocsr()
+
+    indptr = np.zeros(shape[0] + 1, dtype=index_dtype)
+    np.cumsum(np.bincount(cells, minlength=shape[0]), out=indptr[1:])
+    del cells
+    matrix = sp.csr_matrix((data, genes, indptr), shape=shape, copy=False)
+    matrix.sort_indices()
+    return matrix
@@ -0,0 +1,88 @@
+import os
+
+import pandas as pd
+from pandas import DataFrame
+
+from hca_cellxgene.helpers.constants import OBS_FORMATS
+
+
+class ObsWriter:
+    # Writes an obs layer a batch of rows at a time, so only one batch is ever in memory. The rows are numbered on
+    # from the last batch. Categorical columns keep their categories from one batch to the next, adding any new values
+    # to the end, so the codes of a value never change and parquet and feather files stay dictionary encoded with
+    # dictionaries that only grow.
+    def __init__(self, path: os.PathLike, output_format: str = 'csv'):
+        if output_format not in OBS_FORMATS:
+            raise ValueError(f'Unknown obs format {output_format}, expected one of {", ".join(OBS_FORMATS)}')
+        if output_format != 'csv':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError(f'Writing obs as {output_format} needs pyarrow, install it with '
+                                  f'pip install pyarrow') from None
+        self.path = path
+        self.format = output_format
+        self.rows = 0
+        self.__categories: dict[str, pd.Index] = {}
+        self.__file = open(path, 'w', newline='') if output_format == 'csv' else None
+        self.__writer = None
+        self.__schema = None
+
+    def __enter__(self) -> 'ObsWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, obs: DataFrame) -> None:
+        obs = obs.set_axis(pd.RangeIndex(self.rows, self.rows + len(obs)))
+        if self.format == 'csv':
+            obs.to_csv(self.__file, header=self.rows == 0)
+        else:
+            self.__write_arrow(self.__keep_categories(obs))
+        self.rows += len(obs)
+
+    def close(self) -> None:
+        if self.format == 'csv':
+            self.__file.close()
+            return
+        if self.__writer is None:
+            # Nothing was appended, but the file should still exist
+            self.__write_arrow(DataFrame())
+        self.__writer.close()
+
+    def __keep_categories(self, obs: DataFrame) -> DataFrame:
+        columns = {}
+        for column in obs.columns:
+            values = obs[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                known = self.__categories.get(column, pd.Index([], dtype=object))
+                new = values.cat.categories[~values.cat.categories.isin(known)]
+                self.__categories[column] = known.append(new) if len(new) else known
+                values = values.cat.set_categories(self.__categories[column])
+            columns[column] = values
+        return DataFrame(columns, index=obs.index)
+
+    def __write_arrow(self, obs: DataFrame) -> None:
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(obs, preserve_index=False)
+        if self.__writer is None:
+            # The size of the codes pandas uses depends on the number of categories in a batch, so it is fixed for the
+            # whole file. The pandas metadata is dropped as the categories it records are only those of the first batch
+            schema = pa.schema([
+                pa.field(x.name, pa.dictionary(pa.int32(), x.type.value_type)) if pa.types.is_dictionary(x.type) else x
+                for x in table.schema
+            ])
+            self.__schema = schema
+            self.__writer = self.__open_arrow(schema)
+        self.__writer.write_table(table.cast(self.__schema))
+
+    def __open_arrow(self, schema):
+        import pyarrow as pa
+
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetWriter(self.path, schema)
+        # The dictionaries of a feather file can't be replaced part way through, only added to
+        return pa.ipc.new_file(self.path, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
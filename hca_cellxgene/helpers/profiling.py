@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Optional
+
+from hca_cellxgene import context
+
+
+def get_peak_rss(who: int = resource.RUSAGE_SELF) -> int:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+class Profiler:
+    # Collects where the time of a run goes: wall and CPU time of each stage, per input row and in aggregate, plus
+    # HTTP requests and bytes per entity type, bytes read from input files, and peak RSS.
+    # Thread safe, as stages are recorded from the event loop thread as well as the main thread.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.stages: dict[str, dict] = {}
+        self.rows: dict[str, dict] = {}
+        self.http: dict[str, dict] = {}
+        self.bytes_read = 0
+
+    @contextmanager
+    def stage(self, name: str, row: str = None):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall_start, time.process_time() - cpu_start, row)
+
+    def add_stage(self, name: str, wall_time: float, cpu_time: float, row: str = None) -> None:
+        with self.__lock:
+            for stages in [self.stages] + ([self.__row(row).setdefault('stages', {})] if row is not None else []):
+                totals = stages.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0, 'count': 0})
+                totals['wall_time'] += wall_time
+                totals['cpu_time'] += cpu_time
+                totals['count'] += 1
+
+    def add_http(self, entity_type: str, response_bytes: int) -> None:
+        with self.__lock:
+            totals = self.http.setdefault(entity_type, {'requests': 0, 'bytes': 0})
+            totals['requests'] += 1
+            totals['bytes'] += response_bytes
+
+    def add_bytes_read(self, file_path: os.PathLike, row: str = None) -> None:
+        size = os.path.getsize(file_path)
+        with self.__lock:
+            self.bytes_read += size
+            if row is not None:
+                self.__row(row)['bytes_read'] = self.__row(row).get('bytes_read', 0) + size
+
+    def set_row_value(self, row: str, key: str, value) -> None:
+        with self.__lock:
+            self.__row(row)[key] = value
+
+    def merge(self, other: dict) -> None:
+        # Merges the report of a profiler that ran in a worker process
+        for row, values in other.get('rows', {}).items():
+            for name, totals in values.get('stages', {}).items():
+                self.add_stage(name, totals['wall_time'], totals['cpu_time'], row)
+            for key, value in values.items():
+                if key == 'bytes_read':
+                    with self.__lock:
+                        self.bytes_read += value
+                        self.__row(row)['bytes_read'] = self.__row(row).get('bytes_read', 0) + value
+                elif key != 'stages':
+                    self.set_row_value(row, key, value)
+
+    def report(self) -> dict:
+        with self.__lock:
+            return {
+                'stages': self.stages,
+                'rows': self.rows,
+                'http': self.http,
+                'bytes_read': self.bytes_read,
+                'peak_rss': {
+                    'main': get_peak_rss(resource.RUSAGE_SELF),
+                    # Largest of the worker processes that have finished
+                    'workers': get_peak_rss(resource.RUSAGE_CHILDREN),
+                },
+            }
+
+    def write(self, path: os.PathLike) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        logging.info(f'Written profile to {path}')
+
+    def __row(self, row: str) -> dict:
+        return self.rows.setdefault(str(row), {})
+
+
+def get_profiler() -> Optional[Profiler]:
+    return context.get('profiler')
+
+
+def stage(name: str, row: str = None, profiler: Profiler = None):
+    # Times a stage with the given profiler, or the profiler of this run if there is one
+    profiler = profiler or get_profiler()
+    return profiler.stage(name, row) if profiler else nullcontext()
+
+
+def save_profile(output_path: os.PathLike) -> None:
+    # The profile of the run, if there is one, is written next to its output
+    profiler = get_profiler()
+    if profiler:
+        profiler.write(Path(output_path).with_suffix('.profile.json'))
@@ -0,0 +1,54 @@
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from hca_cellxgene.helpers import mtx
+
+# Mitochondrial genes go by their symbol, MT-ND1 in human and mt-Nd1 in mouse
+MITO_PREFIX = 'mt-'
+
+
+def get_mito_mask(features_file_paths: list[os.PathLike], gene_index: pd.Index) -> Optional[np.ndarray]:
+    # Which genes of the gene index are mitochondrial, going by the symbols in the second column of the features of
+    # each matrix. None if no features have symbols.
+    mito_ids = set()
+    has_symbols = False
+    for features_file_path in features_file_paths:
+        with mtx.open_text(features_file_path) as f:
+            genes = pd.read_csv(f, sep='\t', header=None, dtype=str)
+        if genes.shape[1] < 2:
+            continue
+        has_symbols = True
+        mito_ids.update(genes[0][genes[1].str.lower().str.startswith(MITO_PREFIX, na=False)])
+    if not has_symbols:
+        logging.warning('None of the features have gene symbols, so pct_counts_mt cannot be computed')
+        return None
+    mask = gene_index.isin(list(mito_ids))
+    logging.info(f'Found {mask.sum()} mitochondrial genes of {len(gene_index)}')
+    return mask
+
+
+def compute_qc_metrics(matrix: sp.csr_matrix, mito_mask: Optional[np.ndarray] = None) -> dict[str, np.ndarray]:
+    # Per cell QC metrics, named as scanpy names them, from the rows of a CSR matrix without densifying it or copying
+    # its data: the genes detected in each cell are the entries stored in its row, its total counts the sum of its row,
+    # and its mitochondrial counts the sum of its row over the mitochondrial genes
+    row_lengths = np.diff(matrix.indptr)
+    total_counts = np.zeros(matrix.shape[0], dtype=np.float64)
+    # reduceat sums from each start to the next, so only rows with entries are given to it, as an empty row would get
+    # the first entry of the next row
+    has_entries = row_lengths > 0
+    if has_entries.any():
+        total_counts[has_entries] = np.add.reduceat(
+            matrix.data[:matrix.indptr[-1]], matrix.indptr[:-1][has_entries], dtype=np.float64
+        )
+
+    metrics = {'total_counts': total_counts, 'n_genes_by_counts': row_lengths.astype(np.int32)}
+    if mito_mask is not None:
+        mito_counts = matrix @ mito_mask.astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics['pct_counts_mt'] = np.where(total_counts > 0, 100 * mito_counts / total_counts, 0)
+    return metrics
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Callable, Iterator, Optional, Sequence
+
+import numpy as np
+
+from hca_cellxgene.helpers import mtx
+
+# Rough memory used by the pandas parser for each entry of a chunk, on top of the matrix itself
+PARSER_BYTES_PER_ENTRY = 128
+
+
+def estimate_matrix_memory(header: mtx.MatrixMarketHeader) -> int:
+    # Rough peak bytes needed to load a matrix with mtx.load_csr, going by its header alone.
+    # The coordinates and values are held once while parsing, and may be held twice if they need reordering into CSR.
+    index_size = np.dtype(mtx.get_index_dtype(header)).itemsize
+    value_size = np.dtype(mtx.DATA_TYPES.get(header.field, np.float64)).itemsize
+    entries = header.nnz * (2 * index_size + value_size)
+    parser = min(header.nnz, mtx.CHUNK_SIZE) * PARSER_BYTES_PER_ENTRY
+    return 2 * entries + (header.columns + 1) * index_size + parser
+
+
+def get_total_memory() -> Optional[int]:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def format_size(size: float) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+
+def create_worker_pool(max_workers: int, preload: list[str] = None) -> ProcessPoolExecutor:
+    # Workers are started by a fork server rather than forked from this process, which by then is running the Ingest
+    # event loop and the submit threads of the scheduler. A process forked while other threads hold a lock, such as
+    # the import lock, can deadlock. The preloaded modules are imported once by the fork server rather than by every
+    # worker.
+    methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    if preload and mp_context.get_start_method() == 'forkserver':
+        mp_context.set_forkserver_preload(preload)
+    return ProcessPoolExecutor(max_workers, mp_context=mp_context)
+
+
+class MemoryAwareScheduler:
+    # Runs jobs on an executor while keeping the sum of their estimated memory within a budget.
+    # Jobs are started largest first, so the biggest matrices don't all end up running together at the end, and smaller
+    # jobs fill the remaining budget and workers. A job that is bigger than the whole budget is run on its own.
+    # Thread safe, so several callers can share one executor and budget.
+    def __init__(self, executor: Executor, max_workers: int, max_memory: Optional[int] = None):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.max_memory = max_memory
+        self.__condition = threading.Condition()
+        self.__running = 0
+        self.__in_use = 0
+
+    def submit(self, fn: Callable, estimate: int, *args, name: str = None) -> Future:
+        # Blocks until there is a free worker and enough of the memory budget for the job
+        name = name or getattr(fn, '__name__', 'job')
+        with self.__condition:
+            while self.__running > 0 and not self.__has_room(estimate):
+                self.__condition.wait()
+
+            if self.max_memory is not None and estimate > self.max_memory:
+                logging.warning(f'{name} is estimated to need {format_size(estimate)}, more than the memory budget '
+                                f'of {format_size(self.max_memory)}. Running it on its own.')
+            self.__running += 1
+            self.__in_use += estimate
+            logging.info(f'Starting {name} ({format_size(estimate)} estimated). {self.__running} of '
+                         f'{self.max_workers} workers busy, {format_size(self.__in_use)} of '
+                         f'{format_size(self.max_memory) if self.max_memory else "unlimited"} memory budget in use.')
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.__release(estimate)
+            raise
+        future.add_done_callback(lambda _: self.__release(estimate))
+        return future
+
+    def map(self, fn: Callable, estimates: Sequence[int], *iterables, names: Sequence[str] = None) -> Iterator:
+        # Like Executor.map, yielding results in input order, but jobs are started largest first within the budget.
+        # Submission happens on a background thread so results can be consumed while later jobs wait for room.
+        jobs = list(zip(*iterables))
+        names = names or [f'{getattr(fn, "__name__", "job")} {i}' for i in range(len(jobs))]
+        results = [Future() for _ in jobs]
+        order = sorted(range(len(jobs)), key=lambda i: estimates[i], reverse=True)
+        logging.info(f'Scheduling {len(jobs)} jobs largest first: {", ".join(names[i] for i in order)}')
+
+        def submit_all():
+            for i in order:
+                try:
+                    future = self.submit(fn, estimates[i], *jobs[i], name=names[i])
+                except Exception as e:
+                    results[i].set_exception(e)
+                    continue
+                future.add_done_callback(lambda f, result=results[i]: MemoryAwareScheduler.__copy_result(f, result))
+
+        threading.Thread(target=submit_all, daemon=True).start()
+        return (x.result() for x in results)
+
+    def __has_room(self, estimate: int) -> bool:
+        if self.__running >= self.max_workers:
+            return False
+        return self.max_memory is None or self.__in_use + estimate <= self.max_memory
+
+    def __release(self, estimate: int) -> None:
+        with self.__condition:
+            self.__running -= 1
+            self.__in_use -= estimate
+            self.__condition.notify_all()
+
+    @staticmethod
+    def __copy_result(source: Future, destination: Future) -> None:
+        if source.exception() is not None:
+            destination.set_exception(source.exception())
+        else:
+            destination.set_result(source.result())
@@ -1,18 +1,12 @@
+import hashlib
 import json
 import os
-import uuid
 from contextlib import contextmanager
 from pathlib import Path
 from urllib.parse import urlparse
 
-import requests
-from dotenv import load_dotenv
-from tqdm import tqdm
-
 from hca_cellxgene import context
 
-load_dotenv()
-
 
 def write_json_file(path: str, content: dict) -> None:
     os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -25,33 +19,27 @@ def read_json_file(path: str) -> dict:
         return json.load(json_file)
 
 
+def get_downloader() -> 'Downloader':
+    # One downloader per run, so every download shares its pool of connections. Imported here so only the commands
+    # that download anything pay for importing requests
+    from hca_cellxgene.helpers.downloader import Downloader
+    if context.get('downloader') is None:
+        context['downloader'] = Downloader()
+    return context['downloader']
+
+
 @contextmanager
-def download_file(url) -> os.PathLike:
-    filename = str(uuid.uuid4()) + os.path.basename(urlparse(url).path)
-    download_dir = Path(context['wd'], 'downloads')
-    download_dir.mkdir(parents=True)
-    download_path = Path(download_dir, filename)
-
-    # Streaming, so we can iterate over the response.
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    total_size_in_bytes = int(response.headers.get('content-length', 0))
-    block_size = 1024  # 1 Kibibyte
-    progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
-
-    f = open(download_path, 'wb+')
-    try:
-        for data in response.iter_content(block_size):
-            progress_bar.update(len(data))
-            f.write(data)
-
-        if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-            raise Exception(f"Something went wrong downloading file from {url}")
-
-        yield Path(download_path)
-    finally:
-        f.close()
-        progress_bar.close()
+def download_file(url, filename: str = None, checksums: dict[str, str] = None) -> os.PathLike:
+    # Files are named after the URL without its query string, which is often a short-lived signature, so an
+    # interrupted download of the same file can be resumed by a later run
+    url_parts = urlparse(url)
+    if not filename:
+        url_hash = hashlib.sha256(f'{url_parts.scheme}://{url_parts.netloc}{url_parts.path}'.encode()).hexdigest()
+        filename = f'{url_hash[:16]}-{os.path.basename(url_parts.path)}'
+    download_dir = Path(os.environ.get('TMP_DIR', 'tmp'), 'downloads')
+    download_dir.mkdir(parents=True, exist_ok=True)
+
+    yield get_downloader().download(url, Path(download_dir, filename), checksums)
 
 
 def get_nested(d: dict, list_of_keys: [str], default=None):
@@ -60,3 +48,20 @@ def get_nested(d: dict, list_of_keys: [str], default=None):
             return default
         d = d[k]
     return d
+
+
+def parse_size(size: str) -> int:
+    # Parses a human readable number of bytes, e.g. 512M or 16G, using binary units
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    size = str(size).strip().upper().removesuffix('IB').removesuffix('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def parse_shard(shard: str) -> (int, int):
+    # Parses a shard given as i/N, where shards are numbered 0 to N - 1
+    index, count = (int(x) for x in str(shard).split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f'Shard {shard} is out of range')
+    return index, count
@@ -0,0 +1,43 @@
+from typing import NamedTuple, Optional
+
+COMPRESSIONS = ['none', 'gzip', 'lzf']
+
+
+class WriterOptions(NamedTuple):
+    # How X of an output h5ad is stored. X is always a CSR matrix with sorted indices, chunked along its data, indices
+    # and indptr datasets. chunk_size is in entries: larger chunks compress better but a random row reads a whole chunk.
+    compression: str = 'none'
+    compression_level: Optional[int] = None
+    chunk_size: int = 2 ** 16
+    # Threads deflating gzip chunks, alongside the thread encoding the next matrix
+    compression_threads: int = 2
+    # String columns of obs with repeated values are stored as categoricals, as AnnData.write does
+    categorical_obs: bool = True
+
+
+# Starting points for --writer-preset, any of which can be overridden by the other writer arguments
+WRITER_PRESETS = {
+    # No compression, as AnnData.write does by default. Fastest to write and read, largest file
+    'default': WriterOptions(),
+    # Light, fast compression
+    'fast': WriterOptions(compression='lzf'),
+    'balanced': WriterOptions(compression='gzip', compression_level=4),
+    # Smallest file, for uploading. Bigger chunks compress better at some cost to random row reads. Levels above 6
+    # are many times slower for next to no gain on count matrices
+    'small': WriterOptions(compression='gzip', compression_level=6, chunk_size=2 ** 18),
+}
+
+
+def get_writer_options(preset: str = 'default', **overrides) -> WriterOptions:
+    if preset not in WRITER_PRESETS:
+        raise ValueError(f'Unknown writer preset {preset}, expected one of {", ".join(WRITER_PRESETS)}')
+    options = WRITER_PRESETS[preset]._replace(**{k: v for k, v in overrides.items() if v is not None})
+    if options.compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {options.compression}, expected one of {", ".join(COMPRESSIONS)}')
+    if options.compression_level is not None and options.compression != 'gzip':
+        raise ValueError(f'Only gzip has compression levels, not {options.compression}')
+    if options.compression_level is not None and not 0 <= options.compression_level <= 9:
+        raise ValueError(f'gzip compression levels are 0 to 9, not {options.compression_level}')
+    if options.chunk_size < 1:
+        raise ValueError(f'Chunk size must be positive, not {options.chunk_size}')
+    return options
@@ -0,0 +1,84 @@
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from hca_cellxgene.helpers.h5ad_writer import StreamingH5ADWriter
+from hca_cellxgene.helpers.writer_options import WriterOptions
+
+try:
+    from anndata.io import read_elem
+except ImportError:
+    from anndata.experimental import read_elem
+
+# Number of non-zero entries read from a shard at once
+MERGE_CHUNK_SIZE = 2 ** 22
+
+
+def read_shard_info(shard_path: os.PathLike) -> (int, int):
+    with h5py.File(shard_path, 'r') as f:
+        shard = read_elem(f['uns']).get('shard') if 'uns' in f else None
+    if not shard:
+        raise ValueError(f'{shard_path} is not a shard written by create-h5ad --shard')
+    return int(shard['index']), int(shard['count'])
+
+
+def __append_shard(writer: StreamingH5ADWriter, shard_path: os.PathLike, chunk_size: int,
+                   genes: Optional[pd.Index]) -> pd.Index:
+    # Copies the cells of a shard a block of rows at a time, so no more than about chunk_size entries are in memory
+    with h5py.File(shard_path, 'r') as f:
+        var = read_elem(f['var'])
+        if genes is not None and not var.index.equals(genes):
+            raise ValueError(f'{shard_path} has different genes to the shards before it')
+        obs = read_elem(f['obs'])
+        x = f['X']
+        if not isinstance(x, h5py.Group) or x.attrs.get('encoding-type') != 'csr_matrix':
+            writer.append_matrix(read_elem(x), obs, var)
+            return var.index
+
+        indptr = x['indptr'][:]
+        n_vars = int(x.attrs['shape'][1])
+        start = 0
+        while start < len(obs):
+            # Take rows until the block has chunk_size entries, or at least one row
+            end = max(start + 1, int(np.searchsorted(indptr, indptr[start] + chunk_size, side='right')) - 1)
+            end = min(end, len(obs))
+            block_indptr = indptr[start:end + 1]
+            matrix = sp.csr_matrix(
+                (x['data'][block_indptr[0]:block_indptr[-1]], x['indices'][block_indptr[0]:block_indptr[-1]],
+                 block_indptr - block_indptr[0]),
+                shape=(end - start, n_vars)
+            )
+            writer.append_matrix(matrix, obs.iloc[start:end], var)
+            start = end
+    return var.index
+
+
+def merge_shards(shard_paths: list[os.PathLike], output_path: os.PathLike, chunk_size: int = MERGE_CHUNK_SIZE,
+                 writer_options: WriterOptions = None):
+    # Combines the partial h5ads written by create-h5ad --shard into one, in shard order so the cells are in the order
+    # of the input. Every shard must be present, and all of them must have the same genes. The writer options set the
+    # compression and chunking of X in the output, whatever they were in the shards.
+    shards = sorted((*read_shard_info(x), x) for x in shard_paths)
+    count = shards[0][1]
+    indexes = [x[0] for x in shards]
+    if any(x[1] != count for x in shards) or indexes != list(range(count)):
+        raise ValueError(f'Expected shards 0 to {count - 1} of {count} exactly once, got {indexes}')
+
+    with h5py.File(shards[0][2], 'r') as f:
+        uns = read_elem(f['uns'])
+    uns.pop('shard')
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with StreamingH5ADWriter(output_path, writer_options) as writer:
+        genes = None
+        for index, _, shard_path in shards:
+            logging.info(f'Merging shard {index} of {count} from {shard_path}')
+            genes = __append_shard(writer, shard_path, chunk_size, genes)
+        writer.close(uns)
+    logging.info(f'Merged {count} shards into {output_path}')
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from hca_cellxgene.azul_manifest import AzulManifest
+from hca_cellxgene.helpers.constants import OBS_BATCH_SIZE
+from hca_cellxgene.helpers.entity_graph import EntityGraph
+from hca_cellxgene.helpers.obs_writer import ObsWriter
+from hca_cellxgene.helpers.profiling import save_profile, stage
+from hca_cellxgene.observation import IngestObservation, build_observations
+from hca_cellxgene.observation_table import ObservationTable
+
+# The obs layer on its own, written by create-obs. Kept apart from building h5ads so create-obs doesn't import
+# anndata, scipy or anything else only needed for the matrices
+
+
+def __build_obs_row(cell_suspension_uuid: str, cell_type: str = None) -> (str, IngestObservation):
+    logging.info(f'building obs row for {cell_suspension_uuid}')
+    return cell_suspension_uuid, IngestObservation(cell_suspension_uuid, cell_type)
+
+
+def __build_obs_rows(cell_suspension_uuids, entity_graph: EntityGraph = None) -> dict[str, IngestObservation]:
+    logging.info(f'building obs rows for {len(cell_suspension_uuids)} cell suspensions')
+    with stage('ingest_metadata'):
+        return asyncio.run(build_observations(list(cell_suspension_uuids), entity_graph))
+
+
+def __get_output_path(output_format: str) -> Path:
+    return Path(os.environ['OUTPUT_PATH'], f'obs.{output_format}')
+
+
+def generate_obs(uuid: str, cell_type: str = None, rows: int = 1, azul_manifest_path: os.PathLike = None,
+                 output_format: str = 'csv', batch_size: int = OBS_BATCH_SIZE):
+    # The metadata comes from the Azul manifest if one is given, otherwise from Ingest
+    if rows < 1:
+        raise IndexError("Rows cannot be less than 1")
+    if azul_manifest_path:
+        with stage('read_manifest'):
+            obs = AzulManifest(azul_manifest_path).get_observation(uuid, cell_type)
+    else:
+        with stage('ingest_metadata'):
+            obs = __build_obs_row(uuid, cell_type)[1]
+
+    output_path = __get_output_path(output_format)
+    with ObsWriter(output_path, output_format) as writer:
+        # Every row is the same, so one batch is built and written as many times as it takes
+        with stage('build_obs'):
+            batch = ObservationTable.from_observation(obs, rows=min(rows, batch_size)).to_data_frame()
+        with stage('write_obs'):
+            for start in range(0, rows, batch_size):
+                writer.append(batch.iloc[:min(batch_size, rows - start)])
+    save_profile(output_path)
+
+
+def generate_obs_from_csv(input_csv: os.PathLike, azul_manifest_path: os.PathLike = None, output_format: str = 'csv',
+                          batch_size: int = OBS_BATCH_SIZE):
+    # The input is read, built and written a batch of rows at a time, so memory doesn't grow with the size of the input
+    manifest = None
+    if azul_manifest_path:
+        with stage('read_manifest'):
+            manifest = AzulManifest(azul_manifest_path)
+    # Shared by every batch so the entities common to their cell suspensions are only fetched once
+    entity_graph = EntityGraph()
+    observations = {}
+
+    output_path = __get_output_path(output_format)
+    with ObsWriter(output_path, output_format) as writer, pd.read_csv(input_csv, chunksize=batch_size) as reader:
+        while True:
+            with stage('read_input'):
+                uuids_and_types = next(reader, None)
+            if uuids_and_types is None:
+                break
+
+            # Build the observation layer only for unique uuids, not for each row as each uuid may be duplicated
+            # multiple times, and only for those not already built for an earlier batch. Saves network requests
+            new_uuids = [x for x in uuids_and_types['uuid'].unique() if x not in observations]
+            if new_uuids and manifest:
+                with stage('read_manifest'):
+                    observations.update(manifest.get_observations(new_uuids))
+            elif new_uuids:
+                observations.update(__build_obs_rows(new_uuids, entity_graph))
+
+            # Each row in the original file only refers to its created observation, the data frame is built in one go
+            with stage('build_obs'):
+                obs = ObservationTable.from_observations(observations, uuids_and_types['uuid'], uuids_and_types['type'])
+                obs = obs.to_data_frame()
+            with stage('write_obs'):
+                writer.append(obs)
+    if len(entity_graph):
+        logging.info(entity_graph.report())
+    save_profile(output_path)
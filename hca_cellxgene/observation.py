@@ -1,20 +1,27 @@
+import asyncio
 import logging
 import os
+import threading
+from concurrent.futures import Future
 from typing import Union, Optional
 
 import pandas as pd
-import requests
-from dotenv import load_dotenv
-from ingest.api.ingestapi import IngestApi
 from pandas import DataFrame
 
+from hca_cellxgene.helpers.entity_graph import EntityGraph
 from hca_cellxgene.helpers.flat_chain import FlatChain
+from hca_cellxgene.helpers.ingest_client import AsyncIngestClient
+from hca_cellxgene.helpers.profiling import stage
 from hca_cellxgene.helpers.utils import get_nested
 
+SEX_ONTOLOGY_TERMS = {
+    'male': 'PATO:0000384',
+    'female': 'PATO:0000383',
+}
+
 
 class Observation:
     def __init__(self, **kwargs):
-        load_dotenv()
         self.fields = [
             'sample_id',
             'assay_ontology_term_id',
@@ -38,13 +45,13 @@ class Observation:
 
 
 class IngestObservation(Observation):
-    def __init__(self, cell_suspension_uuid, cell_type=None):
+    def __init__(self, cell_suspension_uuid, cell_type=None, flat_chain: FlatChain = None):
         self.cell_suspension_uuid = cell_suspension_uuid
 
-        ingest_base = os.environ.get('INGEST_API', 'https://api.ingest.archive.data.humancellatlas.org/')
-        self.ingest_api = IngestApi(ingest_base)
-
-        self.__build_biomaterial_chain()
+        if flat_chain is None:
+            # Convenient for a single observation. Use IngestObservation.create to share a client between many
+            flat_chain = asyncio.run(IngestObservation.__build_biomaterial_chain_standalone(cell_suspension_uuid))
+        self.flat_chain = flat_chain
 
         # There must always be a donor and a specimen but cell line and organoid are optional nodes in tree
         cell_suspension = self.flat_chain.get_link('cell_suspension')
@@ -77,6 +84,11 @@ class IngestObservation(Observation):
 
         super().__init__(**data)
 
+    @classmethod
+    async def create(cls, cell_suspension_uuid, client: AsyncIngestClient, cell_type=None) -> 'IngestObservation':
+        flat_chain = await IngestObservation.__build_biomaterial_chain(cell_suspension_uuid, client)
+        return cls(cell_suspension_uuid, cell_type, flat_chain)
+
     def set_cell_type(self, cell_type: str):
         # Convenience method to allow for setting of cell type after instantiation
         # Useful if have multiple cell suspensions with the same UUID and different cell types then
@@ -84,19 +96,24 @@ class IngestObservation(Observation):
         self.__setattr__('cell_type_ontology_term_id', cell_type)
         return self
 
-    def __get_cell_suspension(self):
-        result = self.ingest_api.get_entity_by_uuid('biomaterials', self.cell_suspension_uuid)
+    @staticmethod
+    async def get_cell_suspension(cell_suspension_uuid: str, client: AsyncIngestClient):
+        ingest_base = os.environ.get('INGEST_API', 'https://api.ingest.archive.data.humancellatlas.org/').rstrip('/')
+        result = await client.get(f'{ingest_base}/biomaterials/search/findByUuid?uuid={cell_suspension_uuid}')
         if IngestObservation.__get_type_of_entity(result) != 'cell_suspension':
             raise TypeError("Is not a cell suspension")
         return result
 
     @staticmethod
-    def __get_lib_prep_for_cell_suspension(cell_suspension) -> Optional[dict]:
-        input_to = IngestObservation.__get_entities_from_link(cell_suspension, 'inputToProcesses')
+    async def __get_lib_prep_for_cell_suspension(cell_suspension, client: AsyncIngestClient) -> Optional[dict]:
+        input_to = await IngestObservation.__get_entities_from_link(cell_suspension, 'inputToProcesses', client)
+        # The protocols of every process are independent so fetch them all at once
+        protocols_of_processes = await asyncio.gather(
+            *(IngestObservation.__get_entities_from_link(process, 'protocols', client) for process in input_to)
+        )
 
         lib_prep = None
-        for process in input_to:
-            output_protocols = IngestObservation.__get_entities_from_link(process, 'protocols')
+        for process, output_protocols in zip(input_to, protocols_of_processes):
             lib_preps = [x for x in output_protocols if 'library_preparation_protocol' in x['content']['describedBy']]
 
             if len(lib_preps) > 1:
@@ -115,15 +132,10 @@ class IngestObservation(Observation):
         return lib_prep
 
     @staticmethod
-    def __get_entities_from_link(entity: dict, link: str) -> Union[list[dict], dict]:
+    async def __get_entities_from_link(entity: dict, link: str, client: AsyncIngestClient) -> Union[list[dict], dict]:
         logging.info(f'Getting {link} for {IngestObservation.__get_type_of_entity(entity)} {entity["uuid"]["uuid"]}')
 
-        r = requests.get(
-            entity['_links'][link]['href']
-        )
-
-        r.raise_for_status()
-        link_result = r.json()
+        link_result = await client.get(entity['_links'][link]['href'])
 
         return list(link_result['_embedded'].values())[0]
 
@@ -131,7 +143,9 @@ class IngestObservation(Observation):
     def __get_type_of_entity(entity: dict) -> str:
         return entity['content']['describedBy'].split('/')[-1]
 
-    def __add_entities_to_chain(self, entities_to_add: [dict], process_uuid: str, entity_generic_type: str) -> None:
+    @staticmethod
+    def __add_entities_to_chain(flat_chain: FlatChain, entities_to_add: [dict], process_uuid: str,
+                                entity_generic_type: str) -> None:
         if len(entities_to_add) > 1:
             logging.warning(
                 f'Process {process_uuid} has multiple '
@@ -140,18 +154,24 @@ class IngestObservation(Observation):
 
         to_add = entities_to_add[0]
         entity_type = IngestObservation.__get_type_of_entity(to_add)
-        self.flat_chain.append(entity_type, to_add)
+        flat_chain.append(entity_type, to_add)
         logging.info(f'Added {entity_type} {to_add["uuid"]["uuid"]} to chain.')
 
-    def __build_biomaterial_chain(self) -> None:
-        logging.info(f'Building chain of biomaterials and protocols for cell suspension {self.cell_suspension_uuid}.')
+    @staticmethod
+    async def __build_biomaterial_chain_standalone(cell_suspension_uuid: str) -> FlatChain:
+        async with AsyncIngestClient() as client:
+            return await IngestObservation.__build_biomaterial_chain(cell_suspension_uuid, client)
+
+    @staticmethod
+    async def __build_biomaterial_chain(cell_suspension_uuid: str, client: AsyncIngestClient) -> FlatChain:
+        logging.info(f'Building chain of biomaterials and protocols for cell suspension {cell_suspension_uuid}.')
         # Build linked list of biomaterial -> protocol (?) -> biomaterial from lib prep protocol to donor organism
-        cell_suspension = self.__get_cell_suspension()
-        lib_prep = IngestObservation.__get_lib_prep_for_cell_suspension(cell_suspension)
+        cell_suspension = await IngestObservation.get_cell_suspension(cell_suspension_uuid, client)
+        lib_prep = await IngestObservation.__get_lib_prep_for_cell_suspension(cell_suspension, client)
 
         # Can use a FlatChain since we know there can only be one entity of each entity_type in the chain
         if lib_prep:
-            self.flat_chain = FlatChain(
+            flat_chain = FlatChain(
                 IngestObservation.__get_type_of_entity(lib_prep),
                 lib_prep
             ).append(
@@ -159,34 +179,41 @@ class IngestObservation(Observation):
                 cell_suspension
             )
         else:
-            self.flat_chain = FlatChain(
+            flat_chain = FlatChain(
                 IngestObservation.__get_type_of_entity(cell_suspension),
                 cell_suspension
             )
 
-        while self.flat_chain.current[0] != 'donor_organism':
-            derived_by = IngestObservation.__get_entities_from_link(self.flat_chain.current[1], 'derivedByProcesses')
+        while flat_chain.current[0] != 'donor_organism':
+            derived_by = await IngestObservation.__get_entities_from_link(
+                flat_chain.current[1], 'derivedByProcesses', client
+            )
             if len(derived_by) > 1:
                 # ASSUMPTION: a biomaterial can only be derived by one process
                 logging.warning(
-                    f'Biomaterial {self.flat_chain.current[1]["uuid"]["uuid"]} '
+                    f'Biomaterial {flat_chain.current[1]["uuid"]["uuid"]} '
                     f'is derived by multiple processes. Only using the first.'
                 )
             derived_by = derived_by[0]
 
-            protocols_to_derive = IngestObservation.__get_entities_from_link(derived_by, 'protocols')
-            biomaterials_to_derive = IngestObservation.__get_entities_from_link(derived_by, 'inputBiomaterials')
+            # Sibling links of the same process, so fetch them at the same time
+            protocols_to_derive, biomaterials_to_derive = await asyncio.gather(
+                IngestObservation.__get_entities_from_link(derived_by, 'protocols', client),
+                IngestObservation.__get_entities_from_link(derived_by, 'inputBiomaterials', client)
+            )
 
             if len(protocols_to_derive) > 0:
                 # Protocols may or may not exist for deriving a given biomaterial
-                self.__add_entities_to_chain(
-                    protocols_to_derive, derived_by['uuid']['uuid'], 'protocol'
+                IngestObservation.__add_entities_to_chain(
+                    flat_chain, protocols_to_derive, derived_by['uuid']['uuid'], 'protocol'
                 )
 
-            self.__add_entities_to_chain(
-                biomaterials_to_derive, derived_by['uuid']['uuid'], 'biomaterial'
+            IngestObservation.__add_entities_to_chain(
+                flat_chain, biomaterials_to_derive, derived_by['uuid']['uuid'], 'biomaterial'
             )
 
+        return flat_chain
+
     def __get_tissue_ontology_term(self) -> Optional[str]:
         to_try = ['organoid', 'cell_line', 'specimen_from_organism']
         for biomaterial_type in to_try:
@@ -211,9 +238,40 @@ class IngestObservation(Observation):
 
     @staticmethod
     def __get_sex_ontology_term(donor_organism) -> Optional[str]:
-        sex = get_nested(donor_organism, ['content', 'sex'])
-        if sex == 'male':
-            return 'PATO:0000384'
-        if sex == 'female':
-            return 'PATO:0000383'
-        return None
+        return SEX_ONTOLOGY_TERMS.get(get_nested(donor_organism, ['content', 'sex']))
+
+
+async def build_observations(cell_suspension_uuids: list[str],
+                             entity_graph: EntityGraph = None) -> dict[str, IngestObservation]:
+    # Traverse the Ingest graph for all of the cell suspensions at once, sharing one client and entity graph so
+    # common processes and biomaterials are only fetched once
+    async with AsyncIngestClient(entity_graph) as client:
+        observations = await asyncio.gather(*(IngestObservation.create(x, client) for x in cell_suspension_uuids))
+    return dict(zip(cell_suspension_uuids, observations))
+
+
+def build_observations_in_background(cell_suspension_uuids: list[str],
+                                     entity_graph: EntityGraph = None) -> dict[str, Future]:
+    # Same as build_observations but runs its event loop on a background thread so the caller can get on with other
+    # work. Each cell suspension has its own future, so each observation can be used as soon as it is ready.
+    futures = {x: Future() for x in cell_suspension_uuids}
+
+    async def build(cell_suspension_uuid: str, client: AsyncIngestClient):
+        try:
+            futures[cell_suspension_uuid].set_result(await IngestObservation.create(cell_suspension_uuid, client))
+        except Exception as e:
+            futures[cell_suspension_uuid].set_exception(e)
+
+    async def build_all():
+        try:
+            with stage('ingest_metadata'):
+                async with AsyncIngestClient(entity_graph) as client:
+                    await asyncio.gather(*(build(x, client) for x in futures))
+        except Exception as e:
+            # Don't leave anyone waiting on observations that will never be built
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    threading.Thread(target=asyncio.run, args=(build_all(),), daemon=True).start()
+    return futures
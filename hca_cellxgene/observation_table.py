@@ -0,0 +1,75 @@
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from hca_cellxgene.observation import Observation
+
+
+class ObservationTable:
+    # Columnar obs layer indexed by cell suspension.
+    # Each row only holds a code for its cell suspension (and cell type), the values of the fields are stored once per
+    # unique cell suspension. Memory is proportional to the number of unique values rather than the number of rows,
+    # and the obs layer is built as dictionary encoded (categorical) columns in a single vectorized step.
+    def __init__(self, observations: Sequence[Observation], suspension_codes: np.ndarray,
+                 cell_types: Optional[pd.Categorical] = None):
+        if len(observations) < 1:
+            raise IndexError("An observation table needs at least one observation")
+        if cell_types is not None and len(cell_types) != len(suspension_codes):
+            raise IndexError("There must be a cell type for each row")
+
+        self.observations = list(observations)
+        self.suspension_codes = suspension_codes
+        # If no cell types are given, the cell type of each row's observation is used
+        self.cell_types = cell_types
+
+    @classmethod
+    def from_observation(cls, observation: Observation, cell_types: Sequence[str] = None,
+                         rows: int = None) -> 'ObservationTable':
+        # All rows are from the same cell suspension, e.g. all of the cells of one matrix
+        rows = len(cell_types) if cell_types is not None else rows or 1
+        cell_types = ObservationTable.__to_categorical(cell_types) if cell_types is not None else None
+        return cls([observation], np.zeros(rows, dtype=np.int8), cell_types)
+
+    @classmethod
+    def from_observations(cls, observations: dict[str, Observation], cell_suspension_uuids: Sequence[str],
+                          cell_types: Sequence[str] = None) -> 'ObservationTable':
+        # Each row is the cell suspension with the given UUID. Observations only need building once for each unique UUID
+        suspension_codes, unique_uuids = pd.factorize(np.asarray(cell_suspension_uuids))
+        cell_types = ObservationTable.__to_categorical(cell_types) if cell_types is not None else None
+        return cls([observations[x] for x in unique_uuids], suspension_codes, cell_types)
+
+    def __len__(self) -> int:
+        return len(self.suspension_codes)
+
+    @property
+    def fields(self) -> list[str]:
+        return self.observations[0].fields
+
+    def to_data_frame(self) -> DataFrame:
+        val_if_none = 'unknown'
+        columns = {}
+        for field in self.fields:
+            if field == 'cell_type_ontology_term_id' and self.cell_types is not None:
+                columns[field] = self.cell_types
+                continue
+
+            values = [x.__dict__.get(field, val_if_none) or val_if_none for x in self.observations]
+            if all(isinstance(x, (bool, np.bool_)) for x in values):
+                columns[field] = np.asarray(values, dtype=bool)[self.suspension_codes]
+                continue
+
+            value_codes, categories = pd.factorize(np.asarray(values, dtype=object))
+            columns[field] = pd.Categorical.from_codes(value_codes[self.suspension_codes], categories=categories)
+
+        return pd.DataFrame(columns, index=pd.RangeIndex(len(self)))
+
+    @staticmethod
+    def __to_categorical(cell_types: Sequence[str]) -> pd.Categorical:
+        cell_types = pd.Categorical(cell_types)
+        if cell_types.isna().any():
+            if 'unknown' not in cell_types.categories:
+                cell_types = cell_types.add_categories('unknown')
+            cell_types = cell_types.fillna('unknown')
+        return cell_types
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import aiohttp
+import pandas as pd
+
+from hca_cellxgene.azul_manifest import AzulManifest
+from hca_cellxgene.helpers import mtx
+from hca_cellxgene.helpers.entity_graph import EntityGraph
+from hca_cellxgene.helpers.ingest_client import AsyncIngestClient
+from hca_cellxgene.observation import IngestObservation
+
+INPUT_COLUMNS = ['uuid', 'matrix', 'types', 'barcodes']
+OPTIONAL_INPUT_COLUMNS = ['features']
+# Only this many problems are listed, the rest are counted
+MAX_REPORTED = 20
+
+
+class PreflightError(ValueError):
+    def __init__(self, problems: list[str]):
+        self.problems = problems
+        listed = '\n'.join(f'  {x}' for x in problems[:MAX_REPORTED])
+        more = f'\n  ...and {len(problems) - MAX_REPORTED} more' if len(problems) > MAX_REPORTED else ''
+        super().__init__(f'Preflight found {len(problems)} problem(s) with the input:\n{listed}{more}')
+
+
+def count_lines(file_path: os.PathLike) -> int:
+    # Counts lines without parsing them, counting a last line without a line break too
+    lines = 0
+    last = b'\n'
+    with mtx.open_binary(file_path) as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+
+def check_files(input_df: pd.DataFrame) -> list[str]:
+    # Checks every path exists and that the number of cells in each matrix, going by its header alone, matches the
+    # number of cell types and barcodes, and that the number of genes matches its features if they are given
+    missing_columns = [x for x in INPUT_COLUMNS if x not in input_df.columns]
+    if missing_columns:
+        return [f'Input is missing the column(s) {", ".join(missing_columns)}']
+
+    problems = []
+    columns = INPUT_COLUMNS + [x for x in OPTIONAL_INPUT_COLUMNS if x in input_df.columns]
+    for i, x in enumerate(input_df[columns].itertuples(index=False), start=1):
+        missing = [column for column in columns[1:] if not os.path.isfile(str(getattr(x, column)))]
+        if missing:
+            problems += [f'Row {i}: {column} file {getattr(x, column)} does not exist' for column in missing]
+            continue
+
+        try:
+            header = mtx.read_header(x.matrix)
+        except (ValueError, OSError) as e:
+            problems.append(f'Row {i}: could not read the MatrixMarket header of {x.matrix}: {e}')
+            continue
+
+        # Matrices are genes x cells on disk
+        for column in ['types', 'barcodes']:
+            lines = count_lines(getattr(x, column))
+            if lines != header.columns:
+                problems.append(f'Row {i}: {x.matrix} has {header.columns} cells but {column} file '
+                                f'{getattr(x, column)} has {lines} lines')
+        if 'features' in columns:
+            lines = count_lines(x.features)
+            if lines != header.rows:
+                problems.append(f'Row {i}: {x.matrix} has {header.rows} genes but features file {x.features} has '
+                                f'{lines} lines')
+    return problems
+
+
+async def check_cell_suspensions(cell_suspension_uuids: list[str], entity_graph: EntityGraph = None) -> list[str]:
+    # Looks every cell suspension up at once. The responses land in the entity graph, so when it is shared with
+    # building the observations these lookups aren't repeated
+    async def check(cell_suspension_uuid: str, client: AsyncIngestClient) -> Optional[str]:
+        try:
+            await IngestObservation.get_cell_suspension(cell_suspension_uuid, client)
+        except aiohttp.ClientResponseError as e:
+            return f'Cell suspension {cell_suspension_uuid} could not be found in Ingest ({e.status})'
+        except (TypeError, KeyError):
+            return f'{cell_suspension_uuid} is not a cell suspension'
+        return None
+
+    async with AsyncIngestClient(entity_graph) as client:
+        results = await asyncio.gather(*(check(x, client) for x in cell_suspension_uuids))
+    return [x for x in results if x]
+
+
+def preflight(input_df: pd.DataFrame, entity_graph: EntityGraph = None, cell_suspension_uuids: list[str] = None,
+              azul_manifest: AzulManifest = None) -> None:
+    # Fails fast, before any matrix is parsed, with every problem that can be found cheaply.
+    # Every cell suspension of the input is looked up unless only some of them are given, in the Azul manifest if the
+    # obs layer is built from one, otherwise in Ingest.
+    problems = check_files(input_df)
+    if cell_suspension_uuids is None:
+        cell_suspension_uuids = list(input_df['uuid'].unique())
+    if not problems and azul_manifest:
+        problems = [f'Cell suspension {x} is not in the manifest {azul_manifest.path}'
+                    for x in azul_manifest.get_missing(cell_suspension_uuids)]
+    elif not problems and cell_suspension_uuids:
+        problems = asyncio.run(check_cell_suspensions(cell_suspension_uuids, entity_graph))
+    if problems:
+        raise PreflightError(problems)
+    logging.info(f'Preflight passed for {len(input_df)} rows')
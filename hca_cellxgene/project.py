@@ -1,19 +1,28 @@
 import json
 import logging
 import os
+import re
 import tarfile
 from pathlib import Path
-from typing import Generator
+from typing import Generator, NamedTuple, Optional
 
 import requests
-from dotenv import load_dotenv
 
 from hca_cellxgene import context
 from hca_cellxgene.helpers import utils
 
 # from ingest.api.ingestapi import IngestApi
 
-load_dotenv()
+# Contributor matrices come in MatrixMarket format, e.g. <root>_matrix.mtx.gz, <root>_barcodes.tsv.gz and
+# <root>_features.tsv.gz (genes.tsv.gz in older versions of Cell Ranger), where the root may include a directory
+MEMBER_NAME = re.compile(r'^(?P<root>.*?)[._-]?(?P<kind>matrix\.mtx|barcodes\.tsv|features\.tsv|genes\.tsv)(?:\.gz)?$')
+MEMBER_KINDS = {'matrix.mtx': 'matrix', 'barcodes.tsv': 'barcodes', 'features.tsv': 'features', 'genes.tsv': 'features'}
+
+
+class ContributorMatrix(NamedTuple):
+    matrix: Path
+    barcodes: Path
+    features: Optional[Path] = None
 
 
 # THIS IS PROBABLY NOT GOING TO BE USED NOW
@@ -71,32 +80,56 @@ class Project:
         with utils.download_file(self._get_azul_metadata_download_link()) as file_path:
             return file_path
 
-    def get_contributor_generated_matrices_and_barcodes(self) -> ([os.PathLike], [os.PathLike]):
-        with utils.download_file(self._get_azul_contributor_matrix_download_link()) as file_path:
-            tar = tarfile.open(file_path)
-            extract_dir = Path(context['wd'], 'extracted', self.uuid)
-            extract_dir.mkdir(parents=True, exist_ok=True)
-            tar.extractall(path=extract_dir)
-
-            matrix_barcode_combinations = []
-
-            for matrix in extract_dir.iterdir():
-                if not matrix.is_file():
-                    raise TypeError("Expected tar file of contributor matrices to only contain files")
-
-                if matrix.suffixes == ['mtx', 'gz']:
-                    root_name = matrix.stem.replace('_matrix.mtx.gz', '')
-
-                    for barcode in extract_dir.iterdir():
-                        if barcode.suffixes == ['tsv', 'gz'] \
-                                and "barcodes" in barcode.stem \
-                                and root_name in barcode.stem:
-                            matrix_barcode_combinations.append((matrix, barcode))
-
-            if len(matrix_barcode_combinations) < 1:
-                raise IndexError("Expected at least one matrix and barcode combination with "
-                                 "extensions of \".mtx.gz\" and \"_barcode.tsv.gz\", respectively.")
-
-            return matrix_barcode_combinations
-
-
+    def get_contributor_generated_matrices_and_barcodes(self) -> Generator[ContributorMatrix, None, None]:
+        # The archive is extracted as it is downloaded rather than staged on disk first, and each matrix is yielded as
+        # soon as its barcodes and features have arrived, so it can be parsed while the rest is still downloading
+        extract_dir = Path(context['wd'], 'extracted', self.uuid)
+        extract_dir.mkdir(parents=True, exist_ok=True)
+        members: dict[str, dict[str, Path]] = {}
+        found = 0
+
+        url = self._get_azul_contributor_matrix_download_link()
+        with utils.get_downloader().session.get(url, stream=True) as r:
+            r.raise_for_status()
+            # Reading the raw stream skips requests' decoding, so undo any Content-Encoding the server applied
+            r.raw.decode_content = True
+            with tarfile.open(fileobj=r.raw, mode='r|*') as tar:
+                for member in tar:
+                    if member.isdir():
+                        continue
+                    if not member.isfile():
+                        raise TypeError("Expected tar file of contributor matrices to only contain files")
+
+                    match = MEMBER_NAME.match(member.name)
+                    if not match:
+                        continue
+                    Project.__extract_member(tar, member, extract_dir)
+                    files = members.setdefault(match.group('root'), {})
+                    files[MEMBER_KINDS[match.group('kind')]] = Path(extract_dir, member.name)
+
+                    if all(x in files for x in ContributorMatrix._fields):
+                        found += 1
+                        yield ContributorMatrix(**members.pop(match.group('root')))
+
+        # Matrices without features are only complete once the whole archive has been read
+        for files in members.values():
+            if 'matrix' in files and 'barcodes' in files:
+                found += 1
+                yield ContributorMatrix(files['matrix'], files['barcodes'], files.get('features'))
+
+        if found < 1:
+            raise IndexError("Expected at least one matrix and barcode combination with "
+                             "extensions of \".mtx.gz\" and \"_barcode.tsv.gz\", respectively.")
+
+    @staticmethod
+    def __extract_member(tar: tarfile.TarFile, member: tarfile.TarInfo, extract_dir: Path) -> None:
+        # The data filter refuses members that would be written outside of the directory, but only exists from Python
+        # 3.9.17, 3.10.12 and 3.11.4. On earlier releases the member's path is checked here instead, and its mode and
+        # owner are not applied, as the filter would do
+        if hasattr(tarfile, 'data_filter'):
+            tar.extract(member, path=extract_dir, filter='data')
+            return
+        target = Path(extract_dir, member.name).resolve()
+        if os.path.isabs(member.name) or not target.is_relative_to(Path(extract_dir).resolve()):
+            raise TypeError(f'Tar member {member.name} would be extracted outside of {extract_dir}')
+        tar.extract(member, path=extract_dir, set_attrs=False)
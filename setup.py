@@ -9,20 +9,22 @@ setup(
     name='ingest-cellxgene-submitter',
     python_requires='>=3.9',
     version='0.0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     url='',
     license='MIT',
     author='Jacob Windsor',
     author_email='jcbwndsr@ebi.ac.uk',
     description='Convert project from HCA to cellxgene format',
-    install_requires=[
-        'hca-ingest @ git+https://github.com/ebi-ait/ingest-client.git@289a333#egg=hca_ingest',
-        install_requires,
-    ],
+    install_requires=install_requires,
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'create-obs=hca_cellxgene.cli:create_obs',
-            'create-h5ad=hca_cellxgene.cli:create_h5ad'
+            'create-h5ad=hca_cellxgene.cli:create_h5ad',
+            'create-h5ad-batch=hca_cellxgene.cli:create_h5ad_batch',
+            'merge-h5ad=hca_cellxgene.cli:merge_h5ad'
         ],
     },
     include_package_data=True